@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Performance benchmarks for kosh. Each benchmark generates a throwaway
+database in a temporary directory with a fixed passphrase and times
+operations on it. Never point this at a real database.
+
+The shape of the generated database (entries, fields, history, master keys,
+key files and redirects) is set on the command line, and --json saves the
+results along with those parameters so runs can be compared over time.
+"""
+
+import sys
+import os
+import time
+import tempfile
+import shutil
+import json
+import contextlib
+
+PASSPHRASE = 'benchmark'
+
+def prompt(*args):
+  return PASSPHRASE
+
+def unlock_prompt(key_sources, scan_key_file):
+  """Stands in for the unlock dialog, unlocking every key source found."""
+  unlocked = []
+  for ks in key_sources:
+    if ks.source_type == ks.TYPE_PASSPHRASE:
+      unlocked.append((ks, PASSPHRASE, ks.try_unlock(PASSPHRASE)))
+  return (unlocked, [])
+
+def write_lines(filename, lines):
+  with open(filename, 'wb') as fp:
+    fp.writelines(lines)
+
+def generate_db(filename, entries, fields=4, history=1, keys=1, key_files=1, redirects=0,
+    format_version=0):
+  """
+  Create a new database with the given number of entries, each with history
+  revisions, encrypted round robin by keys master keys. The master keys are
+  spread over key_files split .key files, or stored in the database itself
+  like a legacy single file database if key_files is 0. The first redirects
+  of the key files are placed in a subdirectory that is only reachable via
+  r: lines in a <db>-redir.key file. format_version picks between the
+  K05Hv0 and K05Hv1 file formats.
+
+  Every database gets a directory of its own, since all *.key files next to
+  a database are read when it is opened. Lines are written to the files
+  directly rather than through KoshDB.write() so that generating large
+  databases doesn't dominate the benchmark run time.
+  """
+  from koshdb.koshdb import KoshDB, _masterKey, passEntry
+  if redirects > key_files:
+    raise ValueError('Cannot redirect to more key files than there are')
+  dirname = os.path.dirname(os.path.abspath(filename))
+  os.makedirs(dirname, exist_ok=True)
+  master_keys = [_masterKey(PASSPHRASE) for i in range(max(1, keys))]
+  header = KoshDB.FILE_HEADERS[format_version]
+  db_lines = [header]
+  if key_files:
+    key_lines = [[header] for i in range(key_files)]
+    for (i, key) in enumerate(master_keys):
+      key_lines[i % key_files].append(bytes(key) + b'\n')
+    redirect_lines = [header]
+    for (i, lines) in enumerate(key_lines):
+      key_filename = '%s-%i.key' % (os.path.basename(filename), i)
+      if i < redirects:
+        key_filename = os.path.join(dirname, 'redirected', key_filename)
+        os.makedirs(os.path.dirname(key_filename), exist_ok=True)
+        redirect_lines.append(KoshDB.REDIRECT_PREFIX + key_filename.encode('utf-8') + b'\n')
+      else:
+        key_filename = os.path.join(dirname, key_filename)
+      write_lines(key_filename, lines)
+    if redirects:
+      write_lines(filename + '-redir.key', redirect_lines)
+  else:
+    db_lines.extend([bytes(key) + b'\n' for key in master_keys])
+  now = int(time.time())
+  for i in range(entries):
+    key = master_keys[i % len(master_keys)]
+    for revision in range(history):
+      entry = passEntry(key, name=entry_name(i))
+      entry._format = format_version
+      with entry.batch():
+        for field in range(fields):
+          entry['Field%i' % field] = 'value %i of entry %i rev %i' % (field, i, revision)
+        entry._timestamp = now - history + revision
+      db_lines.append(bytes(entry) + b'\n')
+  write_lines(filename, db_lines)
+  for key in master_keys:
+    key.expire()
+
+def entry_name(i):
+  return 'entry%06i' % i
+
+def generate_options_db(options, filename, entries=None):
+  """generate_db() with the database shape given on the command line."""
+  if entries is None:
+    entries = options.entries
+  generate_db(filename, entries, options.fields, options.history,
+      options.keys, options.key_files, options.redirects, options.format)
+  if options.shards:
+    db = open_db(filename)
+    db.shard(options.shards)
+    db.write()
+    close_db(db)
+
+def best_of(repeat, fn, *args, **kwargs):
+  """Return the fastest wall time of repeat calls to fn."""
+  best = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def time_once(fn, *args, **kwargs):
+  """Return the wall time and result of a single call to fn."""
+  start = time.perf_counter()
+  ret = fn(*args, **kwargs)
+  return (time.perf_counter() - start, ret)
+
+def open_db(filename, **kwargs):
+  """Open a database the same way the kosh UI does."""
+  import koshdb
+  return koshdb.KoshDB(filename, prompt, unlock_prompt=unlock_prompt, **kwargs)
+
+def close_db(db):
+  db.__del__()
+  db.fp.close() # Release the lock now rather than whenever it is collected
+
+def open_close(filename, **kwargs):
+  close_db(open_db(filename, **kwargs))
+
+def bench_crypto(options, tmpdir):
+  """
+  Time encrypting and decrypting a single entry with a master key, isolated
+  from file I/O and JSON handling. Runs options.entries iterations of each.
+  """
+  from koshdb.koshdb import _masterKey, passEntry
+  key = _masterKey(PASSPHRASE)
+  entry = passEntry(key, name='entry')
+  with entry.batch():
+    for field in range(options.fields):
+      entry['Field%i' % field] = 'value %i of entry' % field
+  plaintext = json.dumps(dict(entry), sort_keys=True)
+  blob = key.encrypt(plaintext)
+  (head, sealed) = key.seal('', plaintext)
+  def encrypt():
+    for i in range(options.entries):
+      key.encrypt(plaintext)
+  def decrypt():
+    for i in range(options.entries):
+      key.decrypt(blob)
+  def seal():
+    for i in range(options.entries):
+      key.seal('', plaintext)
+  def unseal():
+    for i in range(options.entries):
+      key.unseal_body(head, sealed)
+  results = {}
+  print('%i fields, %i byte plaintext, %i iterations' % (options.fields, len(plaintext), options.entries))
+  print('%i bytes encrypted (v0), %i bytes sealed (v1)' % (len(blob), len(sealed)))
+  print('%8s %10s %12s %12s' % ('op', 'seconds', 'usec/entry', 'entries/sec'))
+  for (name, fn) in (('encrypt', encrypt), ('decrypt', decrypt), ('seal', seal), ('unseal', unseal)):
+    elapsed = best_of(options.repeat, fn)
+    results[name] = elapsed / options.entries
+    print('%8s %10.3f %12.2f %12.0f' % (name, elapsed,
+      elapsed / options.entries * 1e6, options.entries / elapsed))
+  return results
+
+def bench_parallel(options, tmpdir):
+  """Time opening a database serially and with increasing worker counts."""
+  filename = os.path.join(tmpdir, 'koshdb')
+  generate_options_db(options, filename)
+  serial = best_of(options.repeat, open_close, filename)
+  results = {'serial': serial}
+  print('%i entries, %i fields each' % (options.entries, options.fields))
+  print('%8s %10s %8s' % ('jobs', 'seconds', 'speedup'))
+  print('%8s %10.3f %8.2f' % ('serial', serial, 1.0))
+  for jobs in range(1, (os.cpu_count() or 1) + 1):
+    elapsed = best_of(options.repeat, open_close, filename, jobs=jobs)
+    results['jobs=%i' % jobs] = elapsed
+    print('%8i %10.3f %8.2f' % (jobs, elapsed, serial / elapsed))
+  return results
+
+def bench_save(options, tmpdir):
+  """
+  Time a full rewrite of databases of increasing size. The time per line
+  should stay roughly constant if saving scales linearly.
+  """
+  results = []
+  print('%i fields, %i revisions per entry' % (options.fields, options.history))
+  print('%8s %8s %10s %12s' % ('entries', 'lines', 'seconds', 'usec/line'))
+  for divisor in (8, 4, 2, 1):
+    entries = max(1, options.entries // divisor)
+    filename = os.path.join(tmpdir, str(entries), 'koshdb')
+    generate_options_db(options, filename, entries)
+    db = open_db(filename)
+    elapsed = best_of(options.repeat, db.compact)
+    lines = len(db._lines)
+    close_db(db)
+    results.append({'entries': entries, 'lines': lines, 'seconds': elapsed})
+    print('%8i %8i %10.3f %12.1f' % (entries, lines, elapsed, elapsed / lines * 1e6))
+  return results
+
+def bench_suite(options, tmpdir):
+  """
+  Time the operations a kosh session is made of on a single database:
+  opening it (scanning for keys, unlocking, reading and decrypting), saving
+  an edit, rewriting it in full, searching it from the password list and
+  importing new and duplicate entries.
+  """
+  import koshcurses.ui
+  from ui.ui_null import ui_null
+  filename = os.path.join(tmpdir, 'koshdb')
+  generate_options_db(options, filename)
+  results = {}
+  def report(name, elapsed, count=1):
+    results[name] = elapsed
+    print('%-24s %10.3f %12.1f' % (name, elapsed, elapsed / count * 1e6))
+
+  print('%i entries, %i fields, %i revisions, %i keys in %i key files (%i redirected), %i shards, format %i' % (
+    options.entries, options.fields, options.history, options.keys,
+    options.key_files, options.redirects, options.shards, options.format))
+  print('%-24s %10s %12s' % ('operation', 'seconds', 'usec/op'))
+  report('open', best_of(options.repeat, open_close, filename, jobs=options.jobs))
+
+  db = open_db(filename, jobs=options.jobs)
+  try:
+    (elapsed, pwList) = time_once(koshcurses.ui.passwordList, db, ui_null(), ui_null())
+    report('list', elapsed)
+    # The first search decrypts the fields of every entry not yet revealed
+    queries = [('search common', 'value'),
+               ('search unique', entry_name(options.entries // 2)),
+               ('search missing', 'no such entry')]
+    report('search cold', time_once(pwList.search, queries[0][1])[0])
+    # Just indexing, now that every entry has been revealed
+    report('search index', best_of(options.repeat, db._build_search_index, list(db.items())))
+    for (name, query) in queries:
+      report(name, best_of(options.repeat, pwList.search, query))
+    def type_query(query):
+      # As incsearch does, one search per keystroke
+      for i in range(1, len(query) + 1):
+        pwList.search(query[:i])
+    typed = entry_name(options.entries // 3)
+    report('search typing', best_of(options.repeat, type_query, typed), len(typed))
+    pwList.variables = {'fuzzy': True}
+    report('search fuzzy typing', best_of(options.repeat, type_query, typed), len(typed))
+    pwList.variables = {}
+    report('search clear', best_of(options.repeat, pwList.search, None))
+
+    edit = iter(range(options.repeat))
+    def write():
+      entry = db[entry_name(0)].clone()
+      entry['Field0'] = 'edit %i' % next(edit)
+      db[entry.name] = entry
+      db.write()
+    report('write', best_of(options.repeat, write))
+    report('compact', best_of(options.repeat, db.compact))
+
+    def new_entries(start):
+      for i in range(start, start + options.imports):
+        entry = {'name': entry_name(i)}
+        for field in range(options.fields):
+          entry['Field%i' % field] = 'imported value %i of entry %i' % (field, i)
+        yield entry
+    imports = list(new_entries(options.entries))
+    def import_entries():
+      for entry in imports:
+        db.importEntry(entry)
+    report('import new', time_once(import_entries)[0], options.imports)
+    # The same entries again, which should all be skipped as duplicates
+    report('import duplicate', time_once(import_entries)[0], options.imports)
+    report('import write', time_once(db.write)[0])
+  finally:
+    close_db(db)
+  return results
+
+FUZZY_ENTRIES = 50000 # Size a fuzzy search keystroke should stay interactive at
+
+def fuzzy_entries(count):
+  """
+  Yield (name, fields) for count entries made of random words, so that
+  fuzzy queries match them in all sorts of places with gaps in between,
+  as they do real entries. The same entries are generated every time.
+  """
+  import random
+  rand = random.Random(count)
+  letters = 'abcdefghijklmnopqrstuvwxyz'
+  words = [''.join([rand.choice(letters) for j in range(rand.randint(3, 9))]) for i in range(3000)]
+  word = lambda: rand.choice(words)
+  for i in range(count):
+    yield ('%s %s %i' % (word().capitalize(), word(), i), {
+      'Username': '%s%i@%s.com' % (word(), i, word()),
+      'URL': 'https://www.%s.com/%s' % (word(), word()),
+      'Notes': ' '.join([word() for j in range(8)]),
+      'Password': word(),
+    })
+
+def bench_fuzzy(options, tmpdir):
+  """
+  Time fuzzy searches of the search index of options.entries and of
+  FUZZY_ENTRIES entries, each query as a single keystroke from nothing,
+  then typing one character at a time the way the password list does.
+  """
+  from koshdb.search import trigramIndex
+  from koshcurses.ui import passwordList
+  queries = ('ab', 'corp', 'gmail', 'xqzj')
+  typed = 'corpx'
+  results = {}
+  print('%8s %8s %8s %10s %12s' % ('entries', 'query', 'matches', 'seconds', 'usec/entry'))
+  for count in sorted(set([options.entries, FUZZY_ENTRIES])):
+    index = trigramIndex()
+    for (name, fields) in fuzzy_entries(count):
+      index.add(name, fields)
+    def report(name, elapsed, matches):
+      results['%i %s' % (count, name)] = elapsed
+      print('%8i %8s %8i %10.3f %12.2f' % (count, name, matches, elapsed, elapsed / count * 1e6))
+    for query in queries:
+      elapsed = best_of(options.repeat, index.fuzzy, query, None, passwordList.fuzzy_limit)
+      report(query, elapsed, len(index.fuzzy(query)[0]))
+    def type_query():
+      within = None
+      for i in range(1, len(typed) + 1):
+        within = index.fuzzy(typed[:i], within, passwordList.fuzzy_limit)[0]
+      return within
+    report(typed + '/key', best_of(options.repeat, type_query) / len(typed), len(type_query()))
+  return results
+
+benchmarks = {
+  'crypto': bench_crypto,
+  'fuzzy': bench_fuzzy,
+  'parallel': bench_parallel,
+  'save': bench_save,
+  'suite': bench_suite,
+}
+
+def getParameters():
+  import argparse
+  parser = argparse.ArgumentParser(
+    prog='benchmark.py',
+    description='Kosh performance benchmarks',
+  )
+  parser.add_argument('benchmark', choices=sorted(benchmarks),
+                      help='Benchmark to run')
+  parser.add_argument('--entries', '-n', type=int, default=10000,
+                      help='Number of entries to generate (default: %(default)s)')
+  parser.add_argument('--fields', type=int, default=4,
+                      help='Fields per generated entry (default: %(default)s)')
+  parser.add_argument('--history', type=int, default=1,
+                      help='Revisions per generated entry (default: %(default)s)')
+  parser.add_argument('--keys', type=int, default=1,
+                      help='Master keys to encrypt generated entries with (default: %(default)s)')
+  parser.add_argument('--key-files', type=int, default=1,
+                      help='Split .key files to store the master keys in, 0 to store them in the database itself (default: %(default)s)')
+  parser.add_argument('--redirects', type=int, default=0,
+                      help='Key files to only reach via r: redirects (default: %(default)s)')
+  parser.add_argument('--format', type=int, choices=(0, 1), default=0,
+                      help='File format version of generated databases (default: %(default)s)')
+  parser.add_argument('--shards', type=int, default=0,
+                      help='Spread generated entries over this many shard files (default: %(default)s)')
+  parser.add_argument('--imports', type=int, default=1000,
+                      help='Entries to import in the suite benchmark (default: %(default)s)')
+  parser.add_argument('--jobs', '-j', type=int, default=None,
+                      help='Decrypt using this many processes when opening in the suite benchmark')
+  parser.add_argument('--repeat', '-r', type=int, default=3,
+                      help='Report the best of this many runs (default: %(default)s)')
+  parser.add_argument('--json', metavar='FILE',
+                      help='Also write the results as JSON to FILE, or - for stdout')
+  return parser.parse_args()
+
+def write_json(options, results):
+  import platform
+  import version
+  parameters = dict(vars(options))
+  del parameters['json']
+  report = {
+    'benchmark': options.benchmark,
+    'parameters': parameters,
+    'results': results,
+    'time': int(time.time()),
+    'kosh': version.__version__,
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+  }
+  if options.json == '-':
+    json.dump(report, sys.stdout, indent=2)
+    print()
+  else:
+    with open(options.json, 'w') as fp:
+      json.dump(report, fp, indent=2)
+
+def main():
+  options = getParameters()
+  if options.redirects > options.key_files:
+    sys.exit('--redirects cannot exceed --key-files')
+  tmpdir = tempfile.mkdtemp(prefix='kosh-benchmark')
+  # Keep stdout clean for the JSON report if that is where it is going
+  stdout = sys.stderr if options.json == '-' else sys.stdout
+  try:
+    with contextlib.redirect_stdout(stdout):
+      results = benchmarks[options.benchmark](options, tmpdir)
+  finally:
+    shutil.rmtree(tmpdir)
+  if options.json:
+    write_json(options, results)
+
+if __name__ == '__main__':
+  main()
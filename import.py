@@ -155,20 +155,25 @@ def importCSV(filename, headers, db):
 
   headers = askHeaders(fp, cfp, headers)
 
-  print('Importing... ')
-  for line in cfp:
-    entry = {}
-    for (i, field) in enumerate(line):
-      header=headers[i]
-      if not header: continue
-      if field:
-        entry[header] = field
-    #print 'Importing',entry
-    if db.importEntry(entry):
+  def entries():
+    for line in cfp:
+      entry = {}
+      for (i, field) in enumerate(line):
+        header=headers[i]
+        if not header: continue
+        if field:
+          entry[header] = field
+      #print 'Importing',entry
+      yield entry
+
+  def progress(entry, imported):
+    if imported:
       sys.stdout.write('.')
     else:
       sys.stdout.write('x')
-  db.write()
+
+  print('Importing... ')
+  db.bulkImport(entries(), progress)
   print(' done')
   fp.close()
 
@@ -222,7 +222,7 @@ class UnlockDialog(urwid.WidgetWrap):
   chooses Quit (or presses Esc).
 
   showModal() returns:
-    ([(KeySource, passphrase)], [(path, remember_bool)])
+    ([(KeySource, passphrase, unlocked _masterKey)], [(path, remember_bool)])
   or raises SystemExit if the user quits.
 
   Designed to be extensible: future key types (FIDO2, etc.) just need
@@ -429,8 +429,8 @@ class UnlockDialog(urwid.WidgetWrap):
           ks._error_widget.set_text('')
         continue
       try:
-        ks.try_unlock(passphrase)
-        unlocked.append((ks, passphrase))
+        key = ks.try_unlock(passphrase)
+        unlocked.append((ks, passphrase, key))
         if hasattr(ks, '_error_widget'):
           ks._error_widget.set_text('')
       except Exception:
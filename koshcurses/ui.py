@@ -21,10 +21,11 @@ import weakref
 from . import widgets, dialog
 import time
 import sys
-from functools import reduce
 import version
 import otpauth
 import itertools
+import collections
+import os
 
 class passwordList(widgets.keymapwid, urwid.WidgetWrap):
   keymap = {
@@ -38,13 +39,22 @@ class passwordList(widgets.keymapwid, urwid.WidgetWrap):
       'e': 'edit',
       'D': 'delete',
       }
+  variables = {} # The command bar's :set variables, see koshUI
+  fuzzy_limit = 200 # Fuzzy searches list only this many of the best matches
 
   def __init__(self, db, pwForm, ui):
     self.db = db
     self.pwForm = pwForm
     self.ui = ui
     self.showing = None
+    self.current_search = None
+    self.ranked = False # visibleEntries is in order of fuzzy search score
+    self._search_cache = {} # (fuzzy, lowercased query) -> matching names
+    self._search_generation = None # db.generation _search_cache is valid for
     self.visibleEntries = list(self.db.keys())
+    # Buttons are only made for the entries on screen, see refresh()
+    self._walker = widgets.LazyListWalker(lambda name: urwid.Button(name, self.select))
+    self.lb = urwid.ListBox(self._walker)
     self.refresh()
     urwid.WidgetWrap.__init__(self, self.lb)
 
@@ -54,20 +64,21 @@ class passwordList(widgets.keymapwid, urwid.WidgetWrap):
     self.visibleEntries = []
     self.refresh()
 
-  def refresh(self, focus_entry=None):
+  def refresh(self, focus_entry=None, focus_list=True):
     if focus_entry is not None and focus_entry not in self.visibleEntries:
       self.search(None)
-    self.visibleEntries.sort(key = lambda x: x.lower())
-    self.content = [ urwid.Button(x, self.select) for x in self.visibleEntries ]
-    self.lb = urwid.ListBox(self.content)
+    if not self.ranked:
+      self.visibleEntries.sort(key = lambda x: x.lower())
+    self._walker.set_items(self.visibleEntries)
     self.selection = 0
-    self._set_w(self.lb)
     if len(self.visibleEntries):
+      self.lb.set_focus(0)
       try:
         if focus_entry:
           self.showing = self.db[focus_entry]
           self.lb.set_focus(self.visibleEntries.index(focus_entry))
-          self.ui.container.set_focus(0)
+          if focus_list:
+            self.ui.container.set_focus(0)
         else:
           self.showing = self.db[self.lb.get_focus()[0].get_label()]
       except KeyError:
@@ -110,8 +121,13 @@ class passwordList(widgets.keymapwid, urwid.WidgetWrap):
     if not self.showing:
       self.ui.status("No entry selected");
       return
-    if self.showing.older is not None:
-      self.showing = self.showing.older
+    older = self.showing.older
+    if older is None and self.db.load_archive():
+      # Ran past the history read at open, look in the archive for more
+      older = self.showing.older
+      self.ui.status('Loaded archived history')
+    if older is not None:
+      self.showing = older
       self.pwForm.show(self.showing)
 
   def showNewer(self, size, key):
@@ -178,6 +194,8 @@ class passwordList(widgets.keymapwid, urwid.WidgetWrap):
       # clobbering the one being edited.
       self.ui.status("Already editing another entry!");
       return
+    if not self.ui.start_edit():
+      return
     self.ui.container.set_focus(self.pwForm)
     self.pwForm.edit(self.showing.clone(), self.ui.commitNew, self.ui.cancel)
 
@@ -193,35 +211,88 @@ class passwordList(widgets.keymapwid, urwid.WidgetWrap):
       # seems like it is. Prevent accidentally editing a different record
       # clobbering the one being edited.
       return
+    if not self.ui.start_edit():
+      return
 
-    message = 'Really delete %s?' % self.showing.name
-    dlg = dialog.YesNoDialog(message=message)
-    self.ui.mainloop.stop()
-    response = dlg.showModal()
-    self.ui.mainloop.start()
-    if response:
-      del self.db[self.showing]
-      self.showing = None
-      self.visibleEntries = list(self.db.keys())
-      self.refresh()
-      self.db.write()
-
-  def search(self, search):
+    try:
+      message = 'Really delete %s?' % self.showing.name
+      dlg = dialog.YesNoDialog(message=message)
+      self.ui.mainloop.stop()
+      response = dlg.showModal()
+      self.ui.mainloop.start()
+      if response:
+        with self.ui.saver.lock:
+          del self.db[self.showing]
+        self.showing = None
+        self.visibleEntries = list(self.db.keys())
+        self.refresh()
+        self.ui.saver.save()
+    finally:
+      self.ui.release_lock() # If cancelled, otherwise once saved
+
+  def reload(self):
+    """
+    Update the list after entries were reloaded from disk, keeping the
+    current search and selected entry.
+    """
+    focus = None
+    if self.showing is not None and self.showing.newest().name in self.db:
+      focus = self.showing.newest().name
+    self.search(self.current_search, refresh=False)
+    if focus not in self.visibleEntries:
+      focus = None
+    self.refresh(focus, focus_list=False)
+
+  def search(self, search, refresh=True):
+    self.current_search = search
+    self.ranked = False
     if not search:
       self.visibleEntries = list(self.db.keys())
       ret = None
+    elif self.variables.get('fuzzy'):
+      (matches, best) = self._search_matches(search, True)
+      self.visibleEntries = list(best)
+      self.ranked = True
+      ret = len(matches)
     else:
-      self.visibleEntries = []
-      for entry in self.db:
-        # FIXME: Don't (optionally?) search on other protected fields
-        if reduce(lambda x,y: x or search.lower() in y, list(map(str.lower,
-          [entry]+[v for (k,v) in list(self.db[entry].items())
-            if k.lower() not in ['password']])), False):
-            self.visibleEntries.append(entry)
+      self.visibleEntries = list(self._search_matches(search, False))
       ret = len(self.visibleEntries)
-    self.refresh()
+    if refresh:
+      self.refresh()
     return ret
 
+  def _search_matches(self, search, fuzzy):
+    """
+    Return the set of names matching search, or if fuzzy, that and a list
+    of the best of them. Typing another character can only narrow down the
+    matches, so only the matches of the longest earlier query that this one
+    extends are checked. Those are kept until the database changes, so
+    backspacing doesn't search again at all.
+    """
+    query = search.lower()
+    if self._search_generation != self.db.generation:
+      self._search_cache = {}
+      self._search_generation = self.db.generation
+    matches = self._search_cache.get((fuzzy, query))
+    if matches is None:
+      within = None
+      for i in range(len(query) - 1, 0, -1):
+        within = self._search_cache.get((fuzzy, query[:i]))
+        if within is not None:
+          break
+      if fuzzy:
+        if within is not None:
+          within = within[0]
+        matches = self.db.fuzzy_search(search, within, self.fuzzy_limit)
+      else:
+        matches = self.db.search(search, within)
+      self._search_cache[(fuzzy, query)] = matches
+    # Only the queries backspacing would return to are worth keeping
+    for cached in list(self._search_cache):
+      if cached[0] != fuzzy or not query.startswith(cached[1]):
+        del self._search_cache[cached]
+    return matches
+
 class passwordForm(widgets.keymapwid, urwid.WidgetWrap):
   keymap = {
       'y': 'yank',
@@ -506,21 +577,22 @@ class passwordForm(widgets.keymapwid, urwid.WidgetWrap):
     elif 'CopyFieldOrder' in self.entry.meta:
       del self.entry.meta['CopyFieldOrder']
 
-    self.entry.name = self.fname.get_edit_text()
-    for field in self.fields:
-      name = field.caption[:-2] # FIXME: Store in custom attribute
-      txt = field.get_edit_text()
-      if txt != '':
-        self.entry[name] = txt
-        if copy_field_order is not None:
-          clip_order = self.get_clip_order_widget(field).get_edit_text()
-          if clip_order != '':
-            copy_field_order.append((int(clip_order), name))
-      elif name in self.entry:
-        del self.entry[name]
-
-    if copy_field_order is not None:
-      self.entry.meta['CopyFieldOrder'] = list(zip(*sorted(copy_field_order)))[1]
+    with self.entry.batch():
+      self.entry.name = self.fname.get_edit_text()
+      for field in self.fields:
+        name = field.caption[:-2] # FIXME: Store in custom attribute
+        txt = field.get_edit_text()
+        if txt != '':
+          self.entry[name] = txt
+          if copy_field_order is not None:
+            clip_order = self.get_clip_order_widget(field).get_edit_text()
+            if clip_order != '':
+              copy_field_order.append((int(clip_order), name))
+        elif name in self.entry:
+          del self.entry[name]
+
+      if copy_field_order is not None:
+        self.entry.meta['CopyFieldOrder'] = list(zip(*sorted(copy_field_order)))[1]
 
     self.editing = False
     self.okCallback(self.entry)
@@ -634,6 +706,7 @@ class koshUI(widgets.keymapwid, urwid.WidgetWrap):
       }
 
   def __init__(self, db):
+    import koshdb.saver # FIXME: decouple this
     self.db = weakref.proxy(db)
     self.pwEntry = passwordForm(self)
     self.pwList = passwordList(self.db, self.pwEntry, self)
@@ -642,11 +715,27 @@ class koshUI(widgets.keymapwid, urwid.WidgetWrap):
       self.pwEntry
       ] )
     self.vi = widgets.viCommandBar(self.container, search_function=self.pwList.search)
+    self.pwList.variables = self.vi.variables
     self.vi.register_command('splitkey', self.cmd_splitkey)
     self.vi.register_command('passwd', self.cmd_passwd)
+    self.vi.register_command('compact', self.cmd_compact)
+    self.vi.register_command('shard', self.cmd_shard)
+    self.watcher = None
+    self._deferred_reload = set()
+    self._deferred_status = None
+    self._save_events = collections.deque()
+    self._save_pipe = None
+    self.saver = koshdb.saver.writeBehind(self.db, self._saver_notify)
+    self.opened_read_only = db.read_only # Give the exclusive lock back after saving, see release_lock()
+    db.start_search_index() # So the first keystroke of a search doesn't wait for it
     urwid.WidgetWrap.__init__(self, self.vi)
     self.touch()
     self.init_clipboard()
+    status = list(db.warnings)
+    if db.read_only:
+      status.insert(0, 'Opened read only, editing will lock the database')
+    if status:
+      self.status('\n'.join(status))
 
   def touch(self):
     if not hasattr(self, 'expire') or self.expire >= time.time() or self.vi.variables['pause']:
@@ -666,7 +755,7 @@ class koshUI(widgets.keymapwid, urwid.WidgetWrap):
     remaining = math.ceil(self.expire - time.time())
     if remaining < 0:
       if not self.pwEntry.editing:
-        raise urwid.ExitMainLoop()
+        raise urwid.ExitMainLoop() # showModal() flushes any save still running
       # Currently editing an entry - defer closing until the user has saved or
       # cancelled to avoid losing their entry, but prevent access to any other
       # entry incase they left the program open by mistake
@@ -686,28 +775,67 @@ class koshUI(widgets.keymapwid, urwid.WidgetWrap):
 
   def tick(self, mainloop=None, user_data=None):
     self.update_countdown_display()
+    if self._deferred_status is not None and self.vi._mode == 'NORMAL':
+      self.status(self._deferred_status)
+      self._deferred_status = None
     self.pwEntry.tick()
+    if self.watcher is not None and self.watcher.fileno() is None:
+      self.reload()
     self.alarm = self.mainloop.set_alarm_at(time.time() + 1, self.tick)
 
   def new(self, size, key):
     if self.pwEntry.editing:
       return
+    if not self.start_edit():
+      return
     import koshdb # FIXME: decouple this
     entry = koshdb.koshdb.passEntry(self.db._masterKeys[0])
-    entry['Username'] = ''
-    entry['Password'] = ''
-    entry['URL'] = ''
-    entry['Notes'] = '' # FIXME: Multi-line
+    with entry.batch():
+      entry['Username'] = ''
+      entry['Password'] = ''
+      entry['URL'] = ''
+      entry['Notes'] = '' # FIXME: Multi-line
     self.container.set_focus(self.pwEntry)
     self.pwEntry.edit(entry, self.commitNew, self.cancel)
 
+  def start_edit(self):
+    """
+    Check the database can be modified before starting an edit, taking the
+    exclusive lock if it was opened read only. Returns False, and says why
+    in the status bar, if it can't be.
+    """
+    import koshdb # FIXME: decouple this
+    try:
+      with self.saver.lock:
+        self.db.upgrade_lock()
+    except koshdb.koshdb.FileLocked:
+      self.status('Cannot edit: database is open in another instance of kosh')
+      return False
+    except koshdb.koshdb.ReadOnlyDatabase as e:
+      self.status('Cannot edit: %s' % e)
+      return False
+    return True
+
+  def release_lock(self):
+    """
+    Go back to the shared lock start_edit() took the exclusive lock over,
+    if the database was opened read only and nothing is being edited or
+    waiting to be saved, so other read only instances can open it again.
+    """
+    if not self.opened_read_only or self.pwEntry.editing or self.saver.busy():
+      return
+    with self.saver.lock:
+      self.db.downgrade_lock()
+
   def commitNew(self, entry):
-    self.db[entry.name] = entry
-    self.db.write()
+    with self.saver.lock:
+      self.db[entry.name] = entry
+    self.saver.save()
     if self.pwList:
       self.pwList.refresh(entry.name)
 
   def cancel(self, cancelled_entry):
+    self.release_lock()
     # Necessary to get focus back
     self.container.set_focus(0)
     if self.pwList and cancelled_entry:
@@ -717,10 +845,83 @@ class koshUI(widgets.keymapwid, urwid.WidgetWrap):
   def status(self, status, append=False):
     return self.vi.update_status(status, append)
 
+  def _saver_notify(self, event, detail):
+    """Called on the saver thread, hands the event over to the main loop."""
+    self._save_events.append((event, detail))
+    if self._save_pipe is not None:
+      os.write(self._save_pipe, b'.')
+
+  def saver_events(self, data=None):
+    """Report the progress of background saves in the status bar."""
+    while self._save_events:
+      (event, detail) = self._save_events.popleft()
+      if event == 'saving':
+        self.save_status('Saving...')
+      elif event == 'saved':
+        if self.vi._status.text == 'Saving...':
+          self.status('Saved')
+        self.release_lock()
+      elif event == 'error':
+        self.save_status('Error saving database, will retry on the next change or exit: %s' % detail)
+    if self._deferred_reload and not self.saver.busy():
+      self.reload()
+    return True # Keep the pipe open
+
+  def save_status(self, status):
+    """
+    Show status, unless that would clobber a command or search being typed
+    into the status bar, in which case show it once that is done.
+    """
+    if self.vi._mode == 'NORMAL':
+      self.status(status)
+    else:
+      self._deferred_status = status
+
+  def init_watcher(self):
+    """Watch the database files so changes made elsewhere show up live."""
+    import koshdb.watch # FIXME: decouple this
+    self.watcher = koshdb.watch.watch(self.db.watched_files())
+    if self.watcher.fileno() is not None:
+      self.mainloop.watch_file(self.watcher.fileno(), self.reload)
+    # Otherwise tick() polls it
+
+  def reload(self):
+    """Merge in changes made to the database files by something else, e.g. git pull."""
+    import koshdb # FIXME: decouple this
+    changed = self.watcher.check() | self._deferred_reload
+    if not changed or self.pwList is None:
+      return
+    # Our own saves trigger the watcher too. Don't freeze waiting for one to
+    # finish, pick the changes up once it has instead (see saver_events()).
+    if not self.saver.lock.acquire(blocking=False):
+      self._deferred_reload = changed
+      return
+    self._deferred_reload = set()
+    try:
+      names = self.db.reload(changed)
+    except koshdb.koshdb.FileLocked:
+      self.status('Database was replaced on disk, but another instance of kosh has it locked')
+      return
+    finally:
+      self.saver.lock.release()
+    if names:
+      self.pwList.reload()
+      self.status('Reloaded %i changed entries' % len(names))
+
   def showModal(self, parent=None):
     self.mainloop = urwid.MainLoop(self)
     self.vi._outer_loop = self.mainloop
+    self._save_pipe = self.mainloop.watch_pipe(self.saver_events)
+    self.init_watcher()
     self.tick()
+    try:
+      self._run()
+    finally:
+      # Nothing may be lost when exiting, including when the lock timer runs
+      # out, so wait for the last save to hit the disk.
+      self.saver.close()
+
+  def _run(self):
     while True:
       try:
         self.mainloop.run()
@@ -762,22 +963,27 @@ class koshUI(widgets.keymapwid, urwid.WidgetWrap):
     if not keys_in_main:
       self.status('Master key is already in a separate file')
       return
-
-    dlg = dialog.YesNoDialog(
-        message='Move master key(s) to:\n%s\n\nThe main database will no longer\ncontain the master key.' % key_filename)
-    self.mainloop.stop()
-    response = dlg.showModal()
-    self.mainloop.start()
-    if not response:
-      self.status('Cancelled')
+    if not self.start_edit():
       return
-
-    self.db._lines = [
-        (item, key_filename if isinstance(item, koshdb_mod._masterKey) and src == self.db.filename else src)
-        for (item, src) in self.db._lines
-    ]
-    self.db.write()
-    self.status('Master key moved to ' + key_filename)
+    try:
+      dlg = dialog.YesNoDialog(
+          message='Move master key(s) to:\n%s\n\nThe main database will no longer\ncontain the master key.' % key_filename)
+      self.mainloop.stop()
+      response = dlg.showModal()
+      self.mainloop.start()
+      if not response:
+        self.status('Cancelled')
+        return
+
+      with self.saver.lock:
+        self.db._lines = [
+            (item, key_filename if isinstance(item, koshdb_mod._masterKey) and src == self.db.filename else src)
+            for (item, src) in self.db._lines
+        ]
+      self.saver.save(compact=True)
+      self.status('Master key moved to ' + key_filename)
+    finally:
+      self.release_lock() # If cancelled, otherwise once saved
 
   def cmd_passwd(self, args):
     """Change the master passphrase used to protect the database key"""
@@ -792,27 +998,77 @@ class koshUI(widgets.keymapwid, urwid.WidgetWrap):
       self.status('Cannot change passphrase: all master keys are in read-only sources '
                   '(Windows paths):\n' + '\n'.join(readonly_sources))
       return
+    if not self.start_edit():
+      return
+    try:
+      source_list = '\n'.join(writable_sources)
+      dlg1 = dialog.inputDialog(
+          message='Change master passphrase for:\n%s\n\nEnter new passphrase:' % source_list,
+          width=max(42, max(len(s) for s in writable_sources) + 6))
+      dlg2 = dialog.inputDialog(
+          message='Change master passphrase for:\n%s\n\nConfirm new passphrase:' % source_list,
+          width=max(42, max(len(s) for s in writable_sources) + 6))
+      self.mainloop.stop()
+      new_pass = dlg1.showModal()
+      confirm = dlg2.showModal()
+      self.mainloop.start()
+
+      if not new_pass:
+        self.status('Passphrase change cancelled (empty passphrase not allowed)')
+        return
+      if new_pass != confirm:
+        self.status('Passphrases do not match, passphrase not changed')
+        return
+
+      with self.saver.lock:
+        self.db.change_passphrase(new_pass)
+      self.saver.save()
+      self.status('Master passphrase changed')
+    finally:
+      self.release_lock() # If cancelled, otherwise once saved
 
-    source_list = '\n'.join(writable_sources)
-    dlg1 = dialog.inputDialog(
-        message='Change master passphrase for:\n%s\n\nEnter new passphrase:' % source_list,
-        width=max(42, max(len(s) for s in writable_sources) + 6))
-    dlg2 = dialog.inputDialog(
-        message='Change master passphrase for:\n%s\n\nConfirm new passphrase:' % source_list,
-        width=max(42, max(len(s) for s in writable_sources) + 6))
-    self.mainloop.stop()
-    new_pass = dlg1.showModal()
-    confirm = dlg2.showModal()
-    self.mainloop.start()
-
-    if not new_pass:
-      self.status('Passphrase change cancelled (empty passphrase not allowed)')
+  def cmd_shard(self, args):
+    """Spread entries over N shard files, so saves only rewrite what changed: N"""
+    if args is None or not args.strip().isdigit():
+      self.status('Usage: :shard N (0 to move all entries back to the main file)')
       return
-    if new_pass != confirm:
-      self.status('Passphrases do not match, passphrase not changed')
+    if not self.start_edit():
       return
-
-    self.db.change_passphrase(new_pass)
-    self.db.write()
-    self.status('Master passphrase changed')
-
+    try:
+      count = int(args)
+      with self.saver.lock:
+        self.db.shard(count)
+      self.saver.save()
+      if count:
+        self.status('Database split into %i shards' % count)
+      else:
+        self.status('Database no longer sharded')
+    finally:
+      self.release_lock() # If it failed, otherwise once saved
+
+  def cmd_compact(self, args):
+    """Rewrite the database files in full, optionally archiving history: [keep=N] [days=D]"""
+    usage = 'Usage: :compact [keep=N] [days=D]'
+    policy = {}
+    for arg in (args or '').split():
+      (name, _, value) = arg.partition('=')
+      if name not in ('keep', 'days') or not value.isdigit():
+        self.status(usage)
+        return
+      policy[name] = int(value)
+    if not self.start_edit():
+      return
+    try:
+      newer_than = None
+      if 'days' in policy:
+        newer_than = time.time() - policy['days'] * 24 * 60 * 60
+      if not policy:
+        self.saver.save(compact=True)
+        self.status('Database compacted')
+        return
+      # Needs the number archived, so this one is done on the spot
+      with self.saver.lock:
+        archived = self.db.compact(keep=policy.get('keep'), newer_than=newer_than)
+      self.status('Database compacted, %i old revisions archived to %s' % (archived, self.db.archive_filename))
+    finally:
+      self.release_lock() # Saved on the spot with a policy, otherwise once saved
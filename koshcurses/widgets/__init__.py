@@ -21,6 +21,7 @@ from . import utf8
 import types
 from functools import reduce
 import datetime
+import collections
 
 from .viCommandBar import viCommandBar
 
@@ -166,6 +167,62 @@ class LineColumns(urwid.WidgetWrap):
     self.widget_list[idx] = widget
     self.update()
 
+class LazyListWalker(urwid.ListWalker):
+  """
+  List walker over a list of items that only creates the widget for an
+  item, with make_widget(item), when the ListBox asks for it to draw the
+  visible rows. The widgets of the last cache_size items shown are kept, so
+  scrolling back and forth, or a new list of items that shares some with
+  the last, doesn't create them again. Replacing the items with set_items()
+  costs the same no matter how many there are.
+  """
+  def __init__(self, make_widget, items=(), cache_size=256):
+    self._make_widget = make_widget
+    self._cache_size = cache_size
+    self._cache = collections.OrderedDict() # item -> widget, least recently shown first
+    self.items = list(items)
+    self.focus = 0
+
+  def __len__(self):
+    return len(self.items)
+
+  def set_items(self, items, focus=0):
+    """Replace the list of items (not copied), focusing on the position focus."""
+    self.items = items
+    self.focus = focus
+    self._modified()
+
+  def _get(self, position):
+    if position is None or not 0 <= position < len(self.items):
+      return (None, None)
+    item = self.items[position]
+    widget = self._cache.get(item)
+    if widget is None:
+      widget = self._cache[item] = self._make_widget(item)
+      if len(self._cache) > self._cache_size:
+        self._cache.popitem(last=False)
+    else:
+      self._cache.move_to_end(item)
+    return (widget, position)
+
+  def get_focus(self):
+    return self._get(self.focus)
+
+  def set_focus(self, position):
+    self.focus = position
+    self._modified()
+
+  def get_next(self, position):
+    return self._get(position + 1)
+
+  def get_prev(self, position):
+    return self._get(position - 1)
+
+  def positions(self, reverse=False):
+    if reverse:
+      return range(len(self.items) - 1, -1, -1)
+    return range(len(self.items))
+
 class RevealedTOTPWidget(urwid.Button):
   def __init__(self, entry, totp, *a, **kw):
     self.entry = entry
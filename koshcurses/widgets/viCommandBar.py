@@ -76,6 +76,7 @@ class viCommandBar(urwid.WidgetWrap):
     self.variables.update({
       'incsearch': True,
       'pause': False,
+      'fuzzy': False,
     })
 
   def update_status(self, status, append=False):
@@ -20,19 +20,22 @@ import os, sys
 import errno
 try:
   # Getting a bit sick of packages that never heard of backwards compatibility...
-  import Cryptodome.Hash.SHA
   import Cryptodome.Hash.SHA256
   import Cryptodome.Cipher.AES
   import Cryptodome.Util.strxor
   Crypto = Cryptodome
 except ImportError:
-  import Crypto.Hash.SHA
   import Crypto.Hash.SHA256
   import Crypto.Cipher.AES
   import Crypto.Util.strxor
 import base64
 import weakref
 import json
+import contextlib
+import hashlib
+import bisect
+import hmac
+from .profiling import nullProfile
 
 def randBits(size):
   return os.urandom(size//8)
@@ -46,6 +49,27 @@ class Bug(Exception): pass
 class ReadOnlyPassEntry(Exception): pass
 class FileLocked(Exception): pass
 class ReadOnlySourceError(Exception): pass
+class ReadOnlyDatabase(Exception): pass
+class ArchiveError(Exception): pass
+class UnsupportedFormat(Exception): pass
+
+def _resolve_aes_ecb():
+  """
+  pycryptodome changed the AES.new() signature to require the mode, which
+  pycrypto defaulted to ECB. Work out which we have once at import time
+  rather than catching the TypeError on every call.
+  """
+  try:
+    Crypto.Cipher.AES.new(b'\0' * 32)
+  except TypeError:
+    # Using ECB for backwards compatibility. FIXME: Upgrade db to something stronger?
+    return lambda key: Crypto.Cipher.AES.new(key, mode=Crypto.Cipher.AES.MODE_ECB)
+  return Crypto.Cipher.AES.new
+_new_aes_ecb = _resolve_aes_ecb()
+
+# Entry checksums are SHA1. hashlib gives the same digest as Crypto.Hash.SHA
+# with much less per call overhead
+SHA1_DIGEST_SIZE = hashlib.sha1().digest_size
 
 # FIXME: HACK to work with pwsafe imported files for now:
 #passDefaultFieldOrder = ['Username','Password']
@@ -56,6 +80,10 @@ passDefaultCopyFieldOrder = ['Username','login','Password','passwd']
 class _masterKey(object):
   # TODO: Protect self._key (mprotect, accessor methods)
   BLOB_PREFIX = b'k:'
+  KEY_ID_SIZE = 4 # bytes of the key fingerprint stored as a hint on e: lines
+  NONCE_SIZE = 12 # bytes, for v1 records
+  TAG_SIZE = 16 # bytes of the AES-SIV tag, for v1 records
+  BLOB_SIZE = 96 # bytes of a decoded k: blob - the encrypted key and its checksum, then the salt
 
   def __init__(self, passphrase, blob=None):
     if blob is None:
@@ -75,12 +103,36 @@ class _masterKey(object):
       del self._key
     except AttributeError:
       pass
+    self.__dict__.pop('_aes', None)
+    self.__dict__.pop('_v1_key', None)
+    self.__dict__.pop('_shard_key', None)
 
   def __str__(self):
     raise NotImplemented('python3')
   def __bytes__(self):
     return self.BLOB_PREFIX + self._blob
 
+  def key_id(self):
+    """
+    Return a short non-secret identifier for this key, used to tag e: lines
+    with the key that encrypted them so they can be decrypted without trying
+    every master key in turn. It is derived from the key itself rather than
+    the k: blob so it survives a passphrase change.
+    """
+    if '_key_id' not in self.__dict__:
+      h = Crypto.Hash.SHA256.new(b'K05H key id\0' + self._key).digest()
+      self._key_id = base64.b16encode(h[:self.KEY_ID_SIZE]).lower()
+    return self._key_id
+
+  def _cipher(self):
+    """
+    Return the AES cipher for this key, expanding the key schedule on first
+    use. ECB holds no state between blocks so one object serves every call.
+    """
+    if '_aes' not in self.__dict__:
+      self._aes = _new_aes_ecb(self._key)
+    return self._aes
+
   def __setattr__(self, name, val):
     if name == '_key': self.expire()
     object.__setattr__(self, name, val)
@@ -91,6 +143,89 @@ class _masterKey(object):
       raise KeyExpired()
     raise AttributeError()
 
+  def _derive_key(self, purpose, size=32):
+    """
+    Return a key for purpose derived from this key with keyed BLAKE2b, so
+    that no two purposes share a key.
+    """
+    return hashlib.blake2b(purpose, key=self._key, digest_size=size).digest()
+
+  def shard_key(self):
+    """Return the key used to pick the shard of an entry, see KoshDB._shard_for()."""
+    if '_shard_key' not in self.__dict__:
+      self._shard_key = self._derive_key(b'K05H shard')
+    return self._shard_key
+
+  def _v1_cipher(self, nonce, *associated):
+    """
+    Return a new AES-SIV cipher for a v1 record, see seal(). The 512 bit key
+    is derived from this key with _derive_key(), and cached.
+    """
+    if '_v1_key' not in self.__dict__:
+      if not hasattr(Crypto.Cipher.AES, 'MODE_SIV'):
+        raise UnsupportedFormat('K05Hv1 databases need the AES-SIV mode of pycryptodome')
+      self._v1_key = self._derive_key(b'K05Hv1 siv', 64)
+    cipher = Crypto.Cipher.AES.new(self._v1_key, Crypto.Cipher.AES.MODE_SIV, nonce=nonce)
+    for data in associated:
+      cipher.update(data)
+    return cipher
+
+  def seal(self, head, body, deterministic=False):
+    """
+    Encrypt and authenticate the head and body of a v1 record, returning
+    them as two base64 encoded blobs so the head can be opened on its own.
+    Both are sealed with AES-SIV under one 96 bit nonce, the head blob
+    holding the nonce, its tag and ciphertext, and the body blob its tag and
+    ciphertext. The head's tag is authenticated along with the body, which
+    ties the body to its head, and as AES-SIV also authenticates the number
+    of inputs neither can pass for the other. The nonce is random, unless
+    deterministic is True in which case the same head and body always seal
+    to the same blobs (e.g. so migrating copies of a database still gives
+    the same lines), which AES-SIV allows without weakening anything else.
+    Raises KeyExpired if this key has timed out.
+    """
+    if deterministic:
+      nonce = b'\0' * self.NONCE_SIZE
+    else:
+      nonce = randBits(self.NONCE_SIZE * 8)
+    (head, head_tag) = self._v1_cipher(nonce).encrypt_and_digest(head.encode('utf8'))
+    (body, body_tag) = self._v1_cipher(nonce, head_tag).encrypt_and_digest(body.encode('utf8'))
+    return (base64.b64encode(nonce + head_tag + head), base64.b64encode(body_tag + body))
+
+  def _split_sealed(self, blob, prefix_size):
+    """Return the first prefix_size bytes of a decoded blob, its tag and the ciphertext."""
+    d = base64.b64decode(blob)
+    if len(d) < prefix_size + self.TAG_SIZE:
+      raise ChecksumFailure()
+    return (d[:prefix_size], d[prefix_size:prefix_size + self.TAG_SIZE], d[prefix_size + self.TAG_SIZE:])
+
+  def _open_sealed(self, cipher, ciphertext, tag):
+    try:
+      return cipher.decrypt_and_verify(ciphertext, tag)
+    except ValueError:
+      raise ChecksumFailure()
+
+  def unseal_head(self, head_blob):
+    """
+    Authenticate and decrypt the head blob from seal().
+    Raises ChecksumFailure if this key was not used to seal the blob.
+    Raises KeyExpired if this key has timed out.
+    """
+    (nonce, tag, ciphertext) = self._split_sealed(head_blob, self.NONCE_SIZE)
+    return self._open_sealed(self._v1_cipher(nonce), ciphertext, tag)
+
+  def unseal_body(self, head_blob, body_blob):
+    """
+    Authenticate and decrypt the body blob from seal(), which must have
+    been sealed along with head_blob.
+    Raises ChecksumFailure if this key was not used to seal the blobs, or
+    they were not sealed together.
+    Raises KeyExpired if this key has timed out.
+    """
+    (nonce, head_tag, _head) = self._split_sealed(head_blob, self.NONCE_SIZE)
+    (_, tag, ciphertext) = self._split_sealed(body_blob, 0)
+    return self._open_sealed(self._v1_cipher(nonce, head_tag), ciphertext, tag)
+
   def encrypt(self, data):
     """
     Take a chunk of data and encrypt it using this key.
@@ -101,13 +236,8 @@ class _masterKey(object):
       padding = multiple - ((len(data) + 1) % multiple)
       return data + b'\0'*padding + bytes([padding+1])
     data = data.encode('utf8')
-    checksum = Crypto.Hash.SHA.new(data).digest()
-    try:
-      a = Crypto.Cipher.AES.new(self._key)
-    except TypeError:
-      # pycryptodome changed function signature to pass mode. Using ECB for
-      # backwards compatibility. FIXME: Upgrade db to something stronger?
-      a = Crypto.Cipher.AES.new(self._key, mode=Crypto.Cipher.AES.MODE_ECB)
+    checksum = hashlib.sha1(data).digest()
+    a = self._cipher()
     s = randBits(256)
     data = Crypto.Util.strxor.strxor(data,extendstr(s, len(data)))
     e = a.encrypt(pad(data + s + checksum, Crypto.Cipher.AES.block_size))
@@ -124,18 +254,16 @@ class _masterKey(object):
       padding = ord(data[-1:])
       return data[:-padding]
     d = base64.decodebytes(blob)
-    try:
-      a = Crypto.Cipher.AES.new(self._key)
-    except TypeError:
-      # pycryptodome changed function signature to pass mode. Using ECB for
-      # backwards compatibility. FIXME: Upgrade db to something stronger?
-      a = Crypto.Cipher.AES.new(self._key, mode=Crypto.Cipher.AES.MODE_ECB)
+    a = self._cipher()
     deciphered = unpad(a.decrypt(d))
-    decrypted = deciphered[:-Crypto.Hash.SHA.digest_size-32]
-    salt      = deciphered[-Crypto.Hash.SHA.digest_size-32:-Crypto.Hash.SHA.digest_size]
-    checksum  = deciphered[-Crypto.Hash.SHA.digest_size:]
+    if len(deciphered) < SHA1_DIGEST_SIZE+32:
+      # Bogus padding from the wrong key can leave too little for the salt
+      raise ChecksumFailure()
+    decrypted = deciphered[:-SHA1_DIGEST_SIZE-32]
+    salt      = deciphered[-SHA1_DIGEST_SIZE-32:-SHA1_DIGEST_SIZE]
+    checksum  = deciphered[-SHA1_DIGEST_SIZE:]
     decrypted = Crypto.Util.strxor.strxor(decrypted,extendstr(salt, len(decrypted)))
-    if checksum != Crypto.Hash.SHA.new(decrypted).digest():
+    if checksum != hashlib.sha1(decrypted).digest():
       raise ChecksumFailure()
     return decrypted
 
@@ -144,12 +272,7 @@ class _masterKey(object):
     h = Crypto.Hash.SHA256.new(passphrase.encode('utf8')).digest()
     s = randBits(256)
     k = Crypto.Util.strxor.strxor(h,s)
-    try:
-      a = Crypto.Cipher.AES.new(k)
-    except TypeError:
-      # pycryptodome changed function signature to pass mode. Using ECB for
-      # backwards compatibility. FIXME: Upgrade db to something stronger?
-      a = Crypto.Cipher.AES.new(k, mode=Crypto.Cipher.AES.MODE_ECB)
+    a = _new_aes_ecb(k)
     checksum = Crypto.Hash.SHA256.new(key).digest()
     e = a.encrypt(key + checksum)
     return base64.encodebytes(e+s).replace(b'\n',b'')
@@ -158,6 +281,7 @@ class _masterKey(object):
     """Create a new _masterKey encrypting the same underlying key with a new passphrase."""
     new_mk = _masterKey.__new__(_masterKey)
     new_mk._key = self._key  # __setattr__ calls expire() on new_mk first (no-op on fresh object)
+    new_mk._key_id = self.key_id()
     new_mk._blob = _masterKey._encMasterKey(self._key, new_passphrase)
     return new_mk
 
@@ -168,12 +292,7 @@ class _masterKey(object):
     e = d[:-256//8]
     s = d[-256//8:]
     k = Crypto.Util.strxor.strxor(h,s)
-    try:
-      a = Crypto.Cipher.AES.new(k)
-    except TypeError:
-      # pycryptodome changed function signature to pass mode. Using ECB for
-      # backwards compatibility. FIXME: Upgrade db to something stronger?
-      a = Crypto.Cipher.AES.new(k, mode=Crypto.Cipher.AES.MODE_ECB)
+    a = _new_aes_ecb(k)
     deciphered = a.decrypt(e)
     key      = deciphered[:-Crypto.Hash.SHA256.digest_size]
     checksum = deciphered[-Crypto.Hash.SHA256.digest_size:]
@@ -183,74 +302,234 @@ class _masterKey(object):
 
 class passEntry(dict):
   BLOB_PREFIX = b'p:'
+  BLOB_PREFIX_V1 = b'e:'
+  BLOB_PREFIXES = (BLOB_PREFIX, BLOB_PREFIX_V1) # indexed by record format
+  HINT_SEPARATOR = b':' # never appears in base64, so separates the parts of a p: line
 
-  def __init__(self, masterKey, blob=None, name=None):
+  def __init__(self, masterKey, blob=None, name=None, contents=None):
+    """
+    contents may be passed along with blob if the blob has already been
+    decrypted elsewhere (e.g. by a worker process), to skip decrypting it again.
+    """
     if type(masterKey) == weakref.ProxyType:
       self._masterKey = masterKey
     else:
       self._masterKey = weakref.proxy(masterKey)
     self._timestamp = None
-    self.older = None
-    self.newer = None
+    self._key_hint = None
+    self._body_blob = None
+    self._batch_depth = 0
+    self._batch_dirty = False
+    self._content_hash = None
+    self._history = None
+    self._format = 0 # record format, see reformat()
     self.meta = {}
     if blob is not None:
-      assert(blob.startswith(self.BLOB_PREFIX))
-      self._blob = blob[len(self.BLOB_PREFIX):]
-      self._dec()
+      if blob.startswith(self.BLOB_PREFIX_V1):
+        self._format = 1
+      (self._key_hint, self._blob, self._body_blob) = self.split_blob(blob)
+      if contents is not None:
+        self._load(contents)
+      else:
+        self._dec()
     elif name is not None:
       self.name = name
     else:
       self.name = ''
 
+  @staticmethod
+  def from_line(masterKey, line, contents=None):
+    """
+    Return a passEntry for a p: or e: line. e: lines, which store the name
+    separately from the fields, are returned as a lazyPassEntry.
+    """
+    if passEntry.split_blob(line)[2] is not None:
+      return lazyPassEntry(masterKey, line, contents=contents)
+    return passEntry(masterKey, line, contents=contents)
+
   def clone(self):
     import copy
     n = passEntry(self._masterKey, name=self.name)
+    n._format = self._format
     dict.__init__(n, self)
     n.meta = copy.copy(self.meta)
     n.meta['RenamedFrom'] = self.newest().name
     return n
 
+  def _history_index(self):
+    """Return the passHistory this entry belongs to, creating it if necessary."""
+    if self._history is None:
+      passHistory(self)
+    return self._history
+
+  @property
+  def older(self):
+    if self._history is None:
+      return None
+    return self._history.older(self)
+
+  @property
+  def newer(self):
+    if self._history is None:
+      return None
+    return self._history.newer(self)
+
   def newest(self):
-    newest = self
-    while newest.newer:
-      newest = newest.newer
-    return newest
+    if self._history is None:
+      return self
+    return self._history.newest()
 
   def history(self):
-    node = self
-    while node is not None:
-      yield node
-      node = node.older
+    """Iterate over this entry and all older revisions, newest first."""
+    if self._history is None:
+      return iter([self])
+    return self._history.iter_from(self)
 
   def __str__(self):
     raise NotImplemented('python3')
   def __bytes__(self):
-    return self.BLOB_PREFIX + self._blob
+    if self._key_hint is None:
+      return self.BLOB_PREFIX + self._blob
+    parts = [self._key_hint, self._blob]
+    if self._body_blob is not None:
+      parts.append(self._body_blob)
+    return self.BLOB_PREFIXES[self._format] + self.HINT_SEPARATOR.join(parts)
+
+  @classmethod
+  def split_blob(cls, line):
+    """
+    Split a p: or e: line into (key_hint, blob, body_blob). The line takes
+    one of the forms:
+
+      p:<blob>                  Name and fields encrypted together
+      e:<hint>:<head>:<body>    Tagged with the encrypting key, with the
+                                name, timestamp and metadata encrypted
+                                separately to the fields (K05Hv1 only)
+
+    Missing parts are returned as None.
+    """
+    assert(line.startswith(cls.BLOB_PREFIXES))
+    parts = line[len(cls.BLOB_PREFIX):].split(cls.HINT_SEPARATOR, 2)
+    if line.startswith(cls.BLOB_PREFIX) or len(parts) != 3:
+      # A malformed e: line fails to decrypt like any other
+      return (None, line[len(cls.BLOB_PREFIX):], None)
+    return tuple(parts)
 
   def __setitem__(self, name, val):
     if self._timestamp is not None:
       raise ReadOnlyPassEntry()
     dict.__setitem__(self, name, val)
-    self._enc()
+    self._changed()
 
   def __delitem__(self, name):
     dict.__delitem__(self, name)
-    self._enc()
+    self._changed()
+
+  def begin(self):
+    """
+    Start a batch of changes. Changing a timestamped entry normally
+    re-encrypts the entire entry each time - within a batch that is deferred
+    until the matching commit(). Batches may be nested.
+    """
+    self._batch_depth += 1
+
+  def commit(self):
+    """End a batch of changes started with begin(), encrypting the entry once if it changed."""
+    assert(self._batch_depth > 0)
+    self._batch_depth -= 1
+    if self._batch_depth == 0 and self._batch_dirty:
+      self._batch_dirty = False
+      self._changed()
+
+  @contextlib.contextmanager
+  def batch(self):
+    """Context manager wrapping begin() and commit()"""
+    self.begin()
+    try:
+      yield self
+    finally:
+      self.commit()
+
+  def _changed(self):
+    if self._batch_depth:
+      self._batch_dirty = True
+    elif self._timestamp is not None:
+      # A new entry is encrypted once timestamp() is called as it is added
+      # to the database, until then it can't be saved anyway
+      self._enc()
 
-  def _enc(self):
-    serialise = json.dumps((self.name, self._timestamp, self, self.meta))
-    self._blob = self._masterKey.encrypt(serialise)
+  def _enc(self, deterministic=False):
+    if self._format == 0:
+      # The p:<blob> form, which every version of kosh can read
+      serialise = json.dumps((self.name, self._timestamp, self, self.meta))
+      self._blob = self._masterKey.encrypt(serialise)
+      (self._key_hint, self._body_blob) = (None, None)
+      return
+    head = json.dumps((self.name, self._timestamp, self.meta), separators=(',', ':'))
+    body = json.dumps(self, sort_keys=True, separators=(',', ':'))
+    (self._blob, self._body_blob) = self._masterKey.seal(head, body, deterministic)
+    self._key_hint = self._masterKey.key_id()
+
+  def reformat(self, record_format, deterministic=False):
+    """
+    Re-encrypt this entry in the given record format: 0 for the p: lines
+    every version of kosh can read, or 1 for the more compact e: lines of
+    K05Hv1 databases. deterministic is passed to _masterKey.seal(), e.g. so
+    that migrating the same p: line on two copies of a database gives the
+    same e: line and they still merge.
+    """
+    if isinstance(self, lazyPassEntry):
+      self._reveal()
+    self._format = record_format
+    self._enc(deterministic)
+
+  def _decrypt(self, blob):
+    if self._format == 0:
+      return self._masterKey.decrypt(blob)
+    return self._masterKey.unseal_head(blob)
 
   def _dec(self):
-    contents = self._masterKey.decrypt(self._blob)
-    (self.name, self._timestamp, data, self.meta) = json.loads(contents)
-    self.update(data)
+    self._load(self._decrypt(self._blob))
+
+  def _load(self, contents):
+    if self._body_blob is None:
+      (self.name, self._timestamp, data, self.meta) = json.loads(contents)
+      self.update(data)
+    else:
+      self._load_head(contents)
+      self._load_body()
+
+  def _load_head(self, contents):
+    (self.name, self._timestamp, self.meta) = json.loads(contents)
+
+  def _load_body(self):
+    body = self._masterKey.unseal_body(self._blob, self._body_blob)
+    dict.update(self, json.loads(body))
+
+  def fields_digest(self):
+    """Return a digest of the fields in this entry."""
+    # hashlib gives the same result with much less per call overhead
+    return hashlib.sha256(json.dumps(self, sort_keys=True).encode('utf8')).hexdigest()
+
+  def content_hash(self):
+    """
+    Return a hash of everything considered by __eq__ (name, fields and
+    metadata, but not the timestamp), suitable for finding duplicates.
+    """
+    if self._content_hash is not None:
+      return self._content_hash
+    content = json.dumps((self.name, self.meta, self.fields_digest()), sort_keys=True)
+    content_hash = hashlib.sha256(content.encode('utf8')).digest()
+    if self._timestamp is not None:
+      # Fields can no longer change, safe to cache
+      self._content_hash = content_hash
+    return content_hash
 
   def timestamp(self):
     import time
     if self._timestamp is None:
       self._timestamp = int(time.time())
-      self._enc()
+      self._changed()
     return self._timestamp
 
   def __cmp__(self, other):
@@ -261,7 +540,17 @@ class passEntry(dict):
 
   def __eq__(self, other):
     # Do not consider timestamp when checking for equality
-    return self.name == other.name and dict.__eq__(self, other) and self.meta == other.meta
+    if self.name != other.name or self.meta != other.meta:
+      return False
+    if isinstance(self, lazyPassEntry) and isinstance(other, lazyPassEntry):
+      # Comparing the fields of lazy entries means decrypting them, which
+      # would undo lazy loading when they are compared as they are read.
+      # A revision is only saved if it differs from the one before, so
+      # these are only taken to be equal if they are the same line.
+      return self._body_blob == other._body_blob
+    if isinstance(self, lazyPassEntry) or isinstance(other, lazyPassEntry):
+      return self.fields_digest() == other.fields_digest()
+    return dict.__eq__(self, other)
 
   def __ne__(self, other):
     return not passEntry.__eq__(self, other)
@@ -313,6 +602,123 @@ class passEntry(dict):
 
     return sortedGen(self, order)
 
+class passHistory(object):
+  """
+  Every revision of an entry, including under previous names, kept sorted
+  oldest to newest by timestamp. Revisions read out of order (e.g. from
+  merged files) are inserted in place with a binary search, and each
+  revision refers back to the history it belongs to so finding the newest
+  revision is O(1).
+  """
+  def __init__(self, entry):
+    self._entries = []
+    self._timestamps = []
+    self.insert(entry)
+
+  def insert(self, entry):
+    # Insert after any revisions with the same timestamp, so the most recently
+    # read wins a tie as it did before the history was sorted:
+    idx = bisect.bisect_right(self._timestamps, entry._timestamp)
+    self._timestamps.insert(idx, entry._timestamp)
+    self._entries.insert(idx, entry)
+    entry._history = self
+
+  def merge(self, other):
+    """Insert every revision of another history into this one."""
+    if other is self:
+      return
+    for entry in other._entries:
+      self.insert(entry)
+
+  def index(self, entry):
+    idx = bisect.bisect_left(self._timestamps, entry._timestamp)
+    while self._entries[idx] is not entry:
+      idx += 1
+    return idx
+
+  def newest(self):
+    return self._entries[-1]
+
+  def older(self, entry):
+    idx = self.index(entry)
+    if idx == 0:
+      return None
+    return self._entries[idx - 1]
+
+  def newer(self, entry):
+    idx = self.index(entry) + 1
+    if idx == len(self._entries):
+      return None
+    return self._entries[idx]
+
+  def iter_from(self, entry):
+    """Iterate over entry and every older revision, newest first."""
+    for idx in range(self.index(entry), -1, -1):
+      yield self._entries[idx]
+
+  def __len__(self):
+    return len(self._entries)
+
+class lazyPassEntry(passEntry):
+  """
+  A passEntry read from an e: line of a K05Hv1 database, which stores the
+  name separately from the fields. Only the name, timestamp and metadata are
+  decrypted when the database is opened - the fields are decrypted the first
+  time anything accesses them, at which point this turns into an ordinary
+  passEntry.
+  """
+  def _load(self, contents):
+    self._load_head(contents)
+
+  def _reveal(self):
+    self._load_body()
+    self.__class__ = passEntry
+
+def _lazy_method(name):
+  def reveal_and_call(self, *args, **kwargs):
+    self._reveal()
+    return getattr(self, name)(*args, **kwargs)
+  return reveal_and_call
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__',
+    '__iter__', '__len__', '__repr__', 'keys', 'values', 'items', 'get',
+    'copy', 'pop', 'popitem', 'clear', 'update', 'setdefault', 'clipIter',
+    'fields_digest'):
+  setattr(lazyPassEntry, _name, _lazy_method(_name))
+del _name
+
+def _decrypt_p_lines(raw_keys, lines):
+  """
+  Worker for parallel opens: decrypt a chunk of p: lines in a separate
+  process. raw_keys are the unlocked master key bytes (master key objects
+  hold weak references and are not picklable). Returns a list parallel to
+  lines of (key index, plaintext), or (None, None) for lines that none of the
+  keys could decrypt, and the number of decrypt attempts made.
+  """
+  keys = []
+  for raw in raw_keys:
+    key = _masterKey.__new__(_masterKey)
+    key._key = raw
+    keys.append(key)
+  results = []
+  attempts = 0
+  last_key = None
+  for line in lines:
+    (hint, blob, _body) = passEntry.split_blob(line)
+    decrypt = _masterKey.unseal_head if line.startswith(passEntry.BLOB_PREFIX_V1) else _masterKey.decrypt
+    for key in KoshDB._key_candidates(keys, hint, last_key):
+      attempts += 1
+      try:
+        results.append((keys.index(key), decrypt(key, blob)))
+      except ChecksumFailure:
+        continue
+      last_key = key
+      break
+    else:
+      results.append((None, None))
+  for key in keys:
+    key.expire()
+  return (results, attempts)
+
 class KeySource:
   """
   Represents a potential key source discovered during a database scan.
@@ -345,11 +751,40 @@ class KeySource:
 
 class KoshDB(dict):
   FILE_HEADER = b'K05Hv0 UNSTABLE\n'
+  FILE_HEADER_V1 = b'K05Hv1 UNSTABLE\n'
+  FILE_HEADERS = (FILE_HEADER, FILE_HEADER_V1) # indexed by format version, all the same length
   REDIRECT_PREFIX = b'r:'
+  SHARD_PREFIX = b's:'
+  SHARD_SUFFIX = '.shard'
+  SHARD_READ_THREADS = 8
+  ARCHIVE_SUFFIX = '.archive'
+  PARALLEL_MIN_LINES = 512  # below this a process pool costs more than it saves
 
   def __init__(self, filename, prompt, key_files=None, key_file_prompt=None,
-               unlock_prompt=None):
+               unlock_prompt=None, jobs=None, profile=None, read_only=False,
+               format_version=0):
+    """
+    jobs: if set, decrypt p: lines using a pool of this many worker processes
+    when opening the database. Note that this hands the unlocked master keys
+    to the worker processes. Lines read later, e.g. by reload() or
+    load_archive(), are decrypted in this process, since starting a pool
+    part way through a session would fork alongside the UI's threads.
+    profile: a profiling.sessionProfile to record the time spent in each
+    phase of opening and writing the database.
+    read_only: open with a shared lock so any number of read only instances
+    can have the database open at once. write() raises ReadOnlyDatabase
+    until upgrade_lock() succeeds, and again after downgrade_lock().
+    format_version: the file format of a new database, 0 or 1 (K05Hv1, with
+    compact e: records). An existing database keeps the format in its
+    header, which kosh-merge --format can migrate between.
+    """
     self.filename = filename
+    self.format_version = format_version
+    self.archive_filename = filename + self.ARCHIVE_SUFFIX
+    self.read_only = read_only
+    self._jobs = jobs
+    self._opening = False  # set while _open() runs, the only time the jobs pool is used
+    self.profile = profile if profile is not None else nullProfile()
     self.lock_fp = None
     self._current_source = None  # Tracks which file is being read, for line source attribution
     self._explicit_key_files = list(key_files) if key_files else []
@@ -357,11 +792,34 @@ class KoshDB(dict):
     self._unlock_prompt = unlock_prompt  # optional: new unified unlock dialog
     self._unresolved_p_lines = []  # p: lines buffered when no master key was yet available
     self._readonly_sources = set()  # sources that must not be written back (e.g. Windows paths)
+    self._last_key = None  # master key that last decrypted a p: line, tried first for p: lines
+    self._pending = []  # (entry, source) lines added since the last write, not yet on disk
+    self._needs_rewrite = False  # set when existing lines changed, so write() must rewrite in full
+    self._content_index = None  # content hashes of live entries, see _get_content_index()
+    self._search_index = None  # trigramIndex of live entries, see search()
+    self._index_thread = None  # building the search index, see start_search_index()
+    self._index_built = None  # [trigramIndex] once _index_thread has built it
+    self._index_changes = None  # set of names for _index_thread's index to catch up on
+    self._histories = {}  # name -> passHistory, including names since deleted or renamed away
+    self._read_cache = None  # abspath -> ((mtime, size), contents) while opening, see _read_source()
+    self._unlocked_keys = {}  # (abspath, lineno) -> (k: line, key) unlocked by the dialog, see _adopt_unlocked_key()
+    self._read_marks = {}  # source -> how far it has been read, see _mark_read()
+    self._change_log = None  # set of changed names while reload() is running
+    self._archive_loaded = False  # set once load_archive() has read the archive
+    self._shard_layout = None  # (shard count, key id) from the s: line, see shard()
+    self._shard_files = set()  # shard files read at open, rewritten even if emptied
+    self._source_versions = {}  # source -> format version of its header when read, see _header_for()
+    self.generation = 0  # incremented on every change to the entries
+    self.warnings = []  # problems found reading the database, for the UI to report
 
     if os.path.isfile(filename):
-      self._open(filename, prompt)
+      with self.profile.phase('open'):
+        self._open(filename, prompt)
+    elif read_only:
+      raise ReadOnlyDatabase('%s does not exist' % filename)
     else:
-      self._create(filename, prompt)
+      with self.profile.phase('create'):
+        self._create(filename, prompt)
 
   def __del__(self):
     if '_masterKeys' in self:
@@ -399,112 +857,338 @@ class KoshDB(dict):
     self._write(filename)
 
   def write(self):
-    self._write(self.filename)
+    """
+    Save any changes. New entries are appended to the end of their source
+    file, so saving costs O(changed entries) rather than O(database). Falls
+    back to a full rewrite via compact() if existing lines have changed (e.g.
+    the passphrase was changed) or a source file cannot safely be appended to.
+    """
+    if self.read_only:
+      raise ReadOnlyDatabase('Database was opened read only')
+    with self.profile.phase('write'):
+      if self._needs_rewrite or not self._append_pending():
+        self.compact()
+
+  def compact(self, keep=None, newer_than=None):
+    """
+    Rewrite every source file in full, replacing each atomically and keeping
+    the previous version as a ~ backup.
+
+    If keep and/or newer_than (a timestamp) are given, old revisions are
+    moved out to the archive first, so they are no longer read when opening
+    the database. A revision stays if it is one of the newest keep revisions
+    of its entry, or is no older than newer_than. Tombstones of deleted
+    entries, and the last revision under a name before it was renamed, stay
+    until they are older than newer_than, since merging in a copy of the
+    database from before then could otherwise bring the entry back. Once a
+    tombstone is older than that, the entire history of the deleted entry is
+    archived. Returns the number of revisions archived.
+    """
+    if self.read_only:
+      raise ReadOnlyDatabase('Database was opened read only')
+    archived = 0
+    if keep is not None or newer_than is not None:
+      with self.profile.phase('archive'):
+        archived = self._archive(self._select_for_archive(keep, newer_than))
+    self._pending = [] # Already in _lines, so will be included in the rewrite
+    self._needs_rewrite = True # Until the rewrite succeeds
+    with self.profile.phase('compact'):
+      self._write(self.filename)
+    self._needs_rewrite = False
+    return archived
+
+  def _append_pending(self):
+    """
+    Append lines added since the last write to their source files, fsyncing
+    each one. Returns False without writing anything if any source would
+    need a full rewrite instead.
+    """
+    if not self._pending:
+      return True
+    sources = {}
+    for (entry, source) in self._pending:
+      if source in self._readonly_sources:
+        return False
+      sources.setdefault(source, []).append(entry)
+
+    unterminated = set()
+    for source in sources:
+      try:
+        if source == self.filename:
+          # Appending through another file object and closing it would drop
+          # our lock, so only use the locked fp, and only if it is still the
+          # file at this path (e.g. it has not been replaced by a git pull).
+          if not os.path.samestat(os.fstat(self.fp.fileno()), os.stat(source)):
+            return False
+          tail = self._unterminated_tail(self.fp)
+        else:
+          with open(source, 'rb') as fp:
+            if fp.read(len(KoshDB.FILE_HEADER)) not in KoshDB.FILE_HEADERS:
+              return False
+            tail = self._unterminated_tail(fp)
+      except (IOError, OSError):
+        return False
+      if tail:
+        # Skipped when the file was read if it was cut off, so appending
+        # after it would leave it broken in the middle of the file - a full
+        # rewrite leaves it out instead. A whole line just needs its newline.
+        if not self._is_whole_line(tail):
+          return False
+        unterminated.add(source)
+
+    with self.profile.phase('append'):
+      for (source, entries) in sources.items():
+        data = b''.join([bytes(entry).strip() + b'\n' for entry in entries])
+        if source in unterminated:
+          data = b'\n' + data
+        if source == self.filename:
+          start = self._append_to_fp(self.fp, data)
+          self._advance_read_mark(source, self.fp, start, data)
+        else:
+          with open(source, 'rb+') as fp:
+            start = self._append_to_fp(fp, data)
+            self._advance_read_mark(source, fp, start, data)
+    self.profile.count('lines appended', len(self._pending))
+    self._pending = []
+    return True
+
+  @staticmethod
+  def _unterminated_tail(fp, chunk_size=4096):
+    """Return the last line of fp if it has no newline, otherwise b''."""
+    end = fp.seek(0, os.SEEK_END)
+    tail = b''
+    while end > 0 and b'\n' not in tail:
+      start = max(0, end - chunk_size)
+      fp.seek(start)
+      tail = fp.read(end - start) + tail
+      end = start
+    return tail[tail.rfind(b'\n') + 1:]
+
+  def _is_whole_line(self, line):
+    """
+    Return True if line, the last line of a file but without a newline, is
+    whole rather than left by an append that was cut off. Entries must
+    decrypt in full with a key unlocked so far, and k: lines must be the
+    full length. Any other line is taken as it is, the same as anywhere else
+    in the file, e.g. after a hand edit that dropped the final newline.
+    """
+    line = line.strip()
+    try:
+      if line.startswith(passEntry.BLOB_PREFIXES):
+        entry = self._decrypt_entry(line)
+        if entry is None:
+          return False
+        len(entry) # Reveals the body of a lazily loaded entry, checking it
+        return True
+      if line.startswith(_masterKey.BLOB_PREFIX):
+        blob = base64.decodebytes(line[len(_masterKey.BLOB_PREFIX):])
+        return len(blob) == _masterKey.BLOB_SIZE
+    except (ChecksumFailure, ValueError, TypeError):
+      return False
+    if line.startswith(self.SHARD_PREFIX):
+      return self._parse_shard_line(line) is not None
+    return True
+
+  @staticmethod
+  def _append_to_fp(fp, data):
+    """
+    Append data to fp and sync it to disk. Returns the prior file size. If
+    the write fails part way the file is truncated back to that size, so a
+    partial line isn't left at the end of it.
+    """
+    fp.seek(0, os.SEEK_END)
+    start = fp.tell()
+    try:
+      fp.write(data)
+      fp.flush()
+      os.fsync(fp.fileno())
+    except:
+      fp.seek(start)
+      fp.truncate(start)
+      raise
+    return start
 
   def _write(self, filename):
     # FIXME: Locking to avoid separate processes clobbering each other
     from tempfile import NamedTemporaryFile
-    from copy import copy
+    import itertools
     bug = False
 
-    entries = copy(self._masterKeys) + list(self.values()) + copy(self._oldEntries)
+    # Every master key and entry should be accounted for by exactly one line
+    # in _lines. Track them by identity so checking off each line written is
+    # O(1), rather than scanning a list comparing entries with __eq__.
+    untracked = {}
+    for entry in itertools.chain(self._masterKeys, self.values(), self._oldEntries):
+      untracked[id(entry)] = entry
 
     # Group lines by source file, preserving within-file order.
     # Skip readonly sources (e.g. Windows paths read via cmd.exe) — they cannot
     # be written back from Linux and their content is reconstructed on each open.
-    # Also remove any non-bytes objects from those skipped lines from entries so
-    # they don't cause AttributeError when passEntry.__eq__ encounters a masterKey
-    # during entries.remove() below.
     sources = {}
     for (line, source) in self._lines:
-      if source in self._readonly_sources:
-        if type(line) != type(b''):
-          try:
-            entries.remove(line)
-          except ValueError:
-            pass
+      if source in self._readonly_sources or source == self.archive_filename:
+        # The archive is only ever appended to, see _archive()
+        untracked.pop(id(line), None)
         continue
       if source not in sources:
         sources[source] = []
       sources[source].append(line)
 
-    # Ensure the main file is always written (even if it has no entries yet)
-    if filename not in sources:
-      sources[filename] = []
+    # Ensure the main file is always written (even if it has no entries yet),
+    # along with any shard that has been emptied
+    for source in [filename] + sorted(self._shard_files):
+      if source not in sources:
+        sources[source] = []
 
-    # Write a temp file for each source
-    temp_names = {}
+    contents = {}
     for source, lines in sources.items():
-      source_dirname = os.path.dirname(os.path.abspath(source))
-      if not os.path.exists(source_dirname):
-        os.makedirs(source_dirname, mode=0o700)
-      with NamedTemporaryFile(mode='wb', delete=False,
-          prefix=os.path.basename(source),
-          dir=source_dirname) as fp:
-
-        fp.write(KoshDB.FILE_HEADER)
-
-        for line in lines:
-          if type(line) == type(b''):
-            fp.write(line)
-          else:
-            fp.write(bytes(line).strip() + b'\n')
-            try:
-              entries.remove(line)
-            except:
-              bug = True
-              fp.write(b"# WARNING: Above entry not found in masterkeys or password entries\n")
-
-        fp.flush()
-        fp.close()
-        temp_names[source] = fp.name
+      data = [self._header_for(source)]
+      for line in lines:
+        if type(line) == type(b''):
+          data.append(line)
+        else:
+          data.append(bytes(line).strip() + b'\n')
+          if untracked.pop(id(line), None) is None:
+            bug = True
+            data.append(b"# WARNING: Above entry not found in masterkeys or password entries\n")
+      contents[source] = data
 
     # Any entries not accounted for by _lines get appended to the main file
-    if entries != []:
+    if untracked:
       bug = True
-      with open(temp_names[filename], 'ab') as fp:
-        fp.write(b"# WARNING: Below entries not tracked\n")
-        for entry in entries:
-          fp.write(bytes(entry).strip() + b'\n')
-        fp.write(b"# WARNING: Above entries not tracked\n")
-
-    # Atomically rename temp files to their targets.
-    # Write key files first, main file last (main file holds the lock).
-    for source, temp_name in temp_names.items():
-      if source == filename:
-        continue
-      if os.path.exists(source):
-        if os.path.exists(source + '~'):
-          os.remove(source + '~')
-        os.rename(source, source + '~')
-      os.rename(temp_name, source)
-
-    # Now rename the main file (close existing fp first so Windows can rename it)
-    if hasattr(self, 'fp'):
-      self.fp.close()
-    if os.path.exists(filename):
-      if os.path.exists(filename + '~'):
-        os.remove(filename + '~')
-      os.rename(filename, filename + '~')
-    os.rename(temp_names[filename], filename)
-
-    # Ensure we (still) have the db locked:
-    self._open_and_lock(filename)
+      data = contents[filename]
+      data.append(b"# WARNING: Below entries not tracked\n")
+      for entry in untracked.values():
+        data.append(bytes(entry).strip() + b'\n')
+      data.append(b"# WARNING: Above entries not tracked\n")
+
+    with self.profile.phase('write temp files'):
+      # Write a temp file for each source that has changed. Skipping the rest
+      # saves the I/O, and leaves their ~ backups and mtimes alone.
+      temp_names = {}
+      for source, data in contents.items():
+        data = b''.join(data)
+        if self._holds(source, data):
+          self.profile.count('files unchanged')
+          continue
+        source_dirname = os.path.dirname(os.path.abspath(source))
+        if not os.path.exists(source_dirname):
+          os.makedirs(source_dirname, mode=0o700)
+        with NamedTemporaryFile(mode='wb', delete=False,
+            prefix=os.path.basename(source),
+            dir=source_dirname) as fp:
+          fp.write(data)
+          fp.flush()
+          fp.close()
+          temp_names[source] = fp.name
+        self.profile.count('lines written', len(sources[source]))
+
+    with self.profile.phase('replace files'):
+      # Atomically rename temp files to their targets.
+      # Write key files first, main file last (main file holds the lock).
+      for source, temp_name in temp_names.items():
+        if source == filename:
+          continue
+        if os.path.exists(source):
+          if os.path.exists(source + '~'):
+            os.remove(source + '~')
+          os.rename(source, source + '~')
+        os.rename(temp_name, source)
+        self._read_marks.pop(source, None) # reload() must compare it in full
+
+      if filename in temp_names:
+        # Now rename the main file (close existing fp first so Windows can rename it)
+        if hasattr(self, 'fp'):
+          self.fp.close()
+        if os.path.exists(filename):
+          if os.path.exists(filename + '~'):
+            os.remove(filename + '~')
+          os.rename(filename, filename + '~')
+        os.rename(temp_names[filename], filename)
+
+        # Ensure we (still) have the db locked:
+        self._open_and_lock(filename)
+        self._read_marks.pop(filename, None)
+    self._shard_files.update([source for source in sources
+        if source.startswith(filename + self.SHARD_SUFFIX)])
 
     if bug:
       raise Bug("Refer to %s for details" % filename)
 
+  def _note_header(self, source, data):
+    """
+    Return True if data, read from the start of source, begins with a kosh
+    file header, noting its format version for _header_for().
+    """
+    header = data[:len(KoshDB.FILE_HEADER)]
+    if header not in KoshDB.FILE_HEADERS:
+      return False
+    self._source_versions[source] = KoshDB.FILE_HEADERS.index(header)
+    return True
+
+  def _header_for(self, source):
+    """
+    Return the file header to write source with. The main file and shards
+    are in the format of the database, but key files (which other databases
+    may share through r: lines) keep the version they were read with, or
+    K05Hv0 if they are new, since they only hold k: lines and older
+    versions of kosh would not find the keys in a K05Hv1 file.
+    """
+    if source == self.filename or source.startswith(self.filename + self.SHARD_SUFFIX):
+      return self.FILE_HEADERS[self.format_version]
+    return self.FILE_HEADERS[self._source_versions.get(source, 0)]
+
+  def _holds(self, source, data):
+    """
+    Return True if the file source already contains exactly data. The main
+    file is only read through the locked fp, since opening and closing
+    another file object on it would drop the lock.
+    """
+    try:
+      if source == self.filename:
+        if not hasattr(self, 'fp'):
+          return False
+        st = os.fstat(self.fp.fileno())
+        if not os.path.samestat(st, os.stat(source)) or st.st_size != len(data):
+          return False
+        self.fp.seek(0)
+        return self.fp.read() == data
+      if os.stat(source).st_size != len(data):
+        return False
+      with open(source, 'rb') as fp:
+        return fp.read() == data
+    except (IOError, OSError):
+      return False
+
   def _open_and_lock(self, filename):
-    self.fp = open(filename, 'rb+') # Must open for write access for lock to succeed
+    try:
+      self.fp = open(filename, 'rb+') # Must open for write access for lock to succeed
+    except PermissionError:
+      if not self.read_only:
+        raise
+      # Can still be read with a shared lock, just never upgraded
+      self.fp = open(filename, 'rb')
+    self._lock(filename)
+
+  def _lock(self, filename):
+    """
+    Lock self.fp, shared if the database is read only or exclusive
+    otherwise. Locking exclusive while holding the shared lock upgrades it.
+    Raises FileLocked if another instance holds a conflicting lock.
+    """
     try:
       import fcntl
-      fcntl.lockf(self.fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      mode = fcntl.LOCK_SH if self.read_only else fcntl.LOCK_EX
+      fcntl.lockf(self.fp, mode | fcntl.LOCK_NB)
     except IOError as e:
       if e.errno not in (errno.EACCES, errno.EAGAIN):
         raise
-      # TODO: Allow read only access
       raise FileLocked()
     except ImportError:
+      if self.read_only:
+        # The lock file below is exclusive only, so read only instances go
+        # without and only ever wait on each other for the exclusive lock.
+        return
       # Windows doesn't have fcntl. Ideally we would just not pass
       # FILE_SHARE_READ when opening the database, but that would need to go
       # through too much win32api. Fall back to using a separate lock file:
@@ -522,6 +1206,392 @@ class KoshDB(dict):
         except (FileExistsError, PermissionError):
           raise FileLocked()
 
+  def upgrade_lock(self):
+    """
+    Make a database opened read only writable, by upgrading to the exclusive
+    lock. Raises FileLocked if other instances still have the database open,
+    or ReadOnlyDatabase if we don't have write access to it. Does nothing if
+    the database is already writable.
+    """
+    if not self.read_only:
+      return
+    if not self.fp.writable():
+      raise ReadOnlyDatabase('No write access to %s' % self.filename)
+    self.read_only = False
+    try:
+      self._lock(self.filename)
+    except:
+      self.read_only = True
+      raise
+
+  def downgrade_lock(self):
+    """
+    Go back to the shared lock taken by a read only open after
+    upgrade_lock(), e.g. once an edit has been saved, so that other read
+    only instances can open the database again. Does nothing if the
+    database is already read only, or has changes that haven't been written
+    yet, since write() raises ReadOnlyDatabase again until upgrade_lock().
+    """
+    if self.read_only or self._pending or self._needs_rewrite:
+      return
+    self.read_only = True
+    self._lock(self.filename) # Converts the exclusive lock, so can't fail
+    if self.lock_fp is not None:
+      # Windows: read only instances go without the lock file, see _lock()
+      self.lock_fp.close()
+      os.remove(self.lock_fp.name)
+      self.lock_fp = None
+
+  # -------------------------------------------------------------------------
+  # Live reload of changes made by something else (e.g. a git pull)
+  # -------------------------------------------------------------------------
+
+  READ_MARK_TAIL = 64 # bytes before a read mark checked to be unchanged
+
+  def watched_files(self):
+    """Return the files that reload() picks up changes from."""
+    sources = set([source for (item, source) in self._lines])
+    sources.add(self.filename)
+    if not self._archive_loaded:
+      # Revisions archived this session, reloading would read the lot
+      sources.discard(self.archive_filename)
+    return sorted(sources - self._readonly_sources)
+
+  def reload(self, sources=None):
+    """
+    Merge in lines that something else (e.g. a git pull, or another instance
+    sharing a read only database) added to the given source files, or all of
+    watched_files(), since they were read. Only lines that aren't already
+    known are decrypted, and they go through the usual conflict resolution in
+    __setitem__. Lines that no unlocked key can decrypt, and new k: and r:
+    lines, are kept as they are so they survive a rewrite, but take effect
+    on the next open. Lines removed from the files are ignored, the same as
+    when merging databases. Returns the set of entry names that changed.
+    """
+    if sources is None:
+      sources = self.watched_files()
+    with self.profile.phase('reload'):
+      self._relock_if_replaced()
+      known = None
+      for source in sources:
+        if source in self._readonly_sources:
+          continue
+        try:
+          if source == self.filename:
+            (lines, appended) = self._read_new_lines(source, self.fp)
+          else:
+            with open(source, 'rb') as fp:
+              (lines, appended) = self._read_new_lines(source, fp)
+        except (IOError, OSError):
+          continue
+        if not appended and known is None:
+          known = set([(item if isinstance(item, bytes) else bytes(item)).strip()
+            for (item, src) in self._lines])
+        for line in lines:
+          stripped = line.strip()
+          if not stripped:
+            continue
+          if not appended:
+            if stripped in known:
+              continue
+            known.add(stripped)
+          if line.startswith(passEntry.BLOB_PREFIXES):
+            self._unresolved_p_lines.append((line, source, len(self._lines)))
+          self._lines.append((line, source))
+        self.profile.count('lines reloaded', len(lines))
+      if not self._unresolved_p_lines:
+        return set()
+      self._change_log = set()
+      try:
+        self._resolve_p_lines()
+      finally:
+        changed = self._change_log
+        self._change_log = None
+      # Anything left is kept in _lines as it is
+      self._unresolved_p_lines = []
+    return changed
+
+  def _relock_if_replaced(self):
+    """
+    If the main database file has been replaced since it was opened (e.g. by
+    a git pull), lock the new file in its place. Raises FileLocked if
+    another instance got to it first.
+    """
+    try:
+      if os.path.samestat(os.fstat(self.fp.fileno()), os.stat(self.filename)):
+        return
+    except OSError:
+      return # Missing for now, e.g. in the middle of a checkout
+    old_fp = self.fp
+    try:
+      self._open_and_lock(self.filename)
+    except:
+      self.fp.close()
+      self.fp = old_fp
+      raise
+    old_fp.close()
+
+  def _read_new_lines(self, source, fp):
+    """
+    Read the lines of source from fp for reload(). Returns (lines, appended):
+    if the file has only been appended to since it was last read, lines are
+    just those that were appended. Otherwise lines are the whole file, which
+    reload() has to compare with _lines.
+    """
+    st = os.fstat(fp.fileno())
+    mark = self._read_marks.get(source)
+    if mark is not None:
+      (ident, end, tail) = mark
+      if ident == (st.st_dev, st.st_ino) and st.st_size >= end:
+        fp.seek(end - len(tail))
+        data = fp.read()
+        if data.startswith(tail):
+          return (self._complete_lines(source, fp, end - len(tail), data, len(tail)), True)
+    fp.seek(0)
+    data = fp.read()
+    if not self._note_header(source, data):
+      return ([], False)
+    return (self._complete_lines(source, fp, 0, data, len(KoshDB.FILE_HEADER)), False)
+
+  def _complete_lines(self, source, fp, offset, data, start):
+    """
+    Split data, read from offset in source, into lines from start, leaving
+    off an unterminated last line that may still be being written.
+    """
+    end = max(start, data.rfind(b'\n') + 1)
+    self._mark_read(source, fp, offset + end, data[:end])
+    return data[start:end].splitlines(True)
+
+  def _mark_read(self, source, fp, end, data):
+    """
+    Note that source has been read up to end, which is the end of a line,
+    and data holds the bytes leading up to it. The next reload() only needs
+    to read from there, provided the file is the same one and the last few
+    bytes before end are unchanged.
+    """
+    st = os.fstat(fp.fileno())
+    self._read_marks[source] = ((st.st_dev, st.st_ino), end, data[-self.READ_MARK_TAIL:])
+
+  def _advance_read_mark(self, source, fp, start, data):
+    """
+    Move the read mark of source past data we appended at start, provided
+    nothing else appended to it since it was last read.
+    """
+    mark = self._read_marks.get(source)
+    st = os.fstat(fp.fileno())
+    if mark is None or mark[0] != (st.st_dev, st.st_ino) or mark[1] != start:
+      return
+    self._mark_read(source, fp, start + len(data), mark[2] + data)
+
+  # -------------------------------------------------------------------------
+  # Sharding
+  # -------------------------------------------------------------------------
+
+  def shard(self, count):
+    """
+    Spread entries over count shard files alongside the main database file
+    (<db>.shard0 and so on), picked by a keyed hash of the entry name, so a
+    save only has to touch the shards with changes rather than one large
+    file. A count of 0 moves every entry back into the main file. Like
+    change_passphrase(), the change is saved by the next write().
+    """
+    if self.read_only:
+      raise ReadOnlyDatabase('Database was opened read only')
+    self._lines = [(item, source) for (item, source) in self._lines
+        if not (isinstance(item, bytes) and item.startswith(self.SHARD_PREFIX))]
+    self._shard_layout = None
+    if count:
+      key_id = self._masterKeys[0].key_id()
+      line = self.SHARD_PREFIX + b'%i:%s\n' % (count, key_id)
+      self._lines.append((line, self.filename))
+      self._shard_layout = (count, key_id)
+    # Entries in key files and other read only sources stay where they are
+    movable = set([self.filename]) | self._shard_files
+    self._lines = [(item, self._shard_for(item.name)
+        if isinstance(item, passEntry) and source in movable else source)
+        for (item, source) in self._lines]
+    self._needs_rewrite = True
+
+  def _parse_shard_line(self, line):
+    """Return (shard count, key id) from an s: line, or None if it is invalid."""
+    try:
+      (count, key_id) = line[len(self.SHARD_PREFIX):].strip().split(b':', 1)
+      return (int(count), key_id)
+    except ValueError:
+      return None
+
+  def _shard_for(self, name):
+    """
+    Return the file a new revision of the entry called name belongs in. The
+    hash is keyed with a key derived from the master key named in the s:
+    line, so the layout doesn't give away which shard a guessed entry name
+    would be in. Falls back to the main file if that key isn't unlocked.
+    """
+    if self._shard_layout is None:
+      return self.filename
+    (count, key_id) = self._shard_layout
+    for key in self._masterKeys:
+      if key.key_id() == key_id:
+        h = hmac.new(key.shard_key(), name.encode('utf8'), hashlib.sha256)
+        return '%s%s%i' % (self.filename, self.SHARD_SUFFIX, int.from_bytes(h.digest()[:8], 'big') % count)
+    return self.filename
+
+  def _get_shard_files(self, filename):
+    """Find the shard files of the database, in shard order."""
+    import glob as glob_module
+    import re
+    pattern = re.compile(re.escape(self.SHARD_SUFFIX) + r'(\d+)$')
+    shards = []
+    for path in glob_module.glob(glob_module.escape(filename + self.SHARD_SUFFIX) + '*'):
+      match = pattern.search(path)
+      if match is not None: # Not e.g. a ~ backup
+        shards.append((int(match.group(1)), path))
+    return [path for (idx, path) in sorted(shards)]
+
+  def _read_shards(self, filename, passphrases, prompt, visited):
+    """
+    Read every shard file found alongside the database, whether or not it
+    is currently sharded (e.g. shards pulled in from another copy). The
+    files are read concurrently, but their lines are processed in shard
+    order as each read completes.
+    """
+    import io
+    import concurrent.futures
+    paths = [path for path in self._get_shard_files(filename)
+        if os.path.abspath(path) not in visited]
+    if not paths:
+      return
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(paths), self.SHARD_READ_THREADS)) as pool:
+      for (path, (data, _err)) in zip(paths, pool.map(self._try_read_file, paths)):
+        visited.add(os.path.abspath(path))
+        if data is None or not self._note_header(path, data):
+          continue
+        self._shard_files.add(path)
+        self._read_lines_from_fp(io.BytesIO(data[len(KoshDB.FILE_HEADER):]), path, passphrases, prompt, visited)
+
+  # -------------------------------------------------------------------------
+  # History archive
+  # -------------------------------------------------------------------------
+
+  def _select_for_archive(self, keep, newer_than):
+    """Return the old revisions compact() should archive, see compact()."""
+    import itertools
+    sources = dict([(id(item), source) for (item, source) in self._lines])
+    live = set([id(entry) for entry in self.values()])
+    histories = {}
+    for entry in itertools.chain(self.values(), self._oldEntries):
+      history = entry._history_index()
+      histories[id(history)] = history
+    selected = []
+    for history in histories.values():
+      revisions = list(history.iter_from(history.newest())) # Newest first
+      head = revisions[0]
+      deleted = 'Deleted' in head.meta and id(head) not in live
+      expired = deleted and newer_than is not None and head._timestamp < newer_than
+      # A tombstone read without the revision it deleted would be taken as
+      # a live entry, so that revision is kept along with it:
+      min_keep = 2 if deleted else 1
+      for (idx, revision) in enumerate(revisions):
+        source = sources.get(id(revision))
+        if id(revision) in live or source is None or source in self._readonly_sources \
+            or source == self.archive_filename:
+          continue
+        if not expired:
+          if idx < min_keep or (keep is not None and idx < keep):
+            continue
+          if newer_than is None:
+            if revision.name != revisions[idx-1].name:
+              continue # Renamed away, and we don't know how old is safe
+          elif revision._timestamp >= newer_than:
+            continue
+        selected.append(revision)
+    return selected
+
+  def _archive(self, entries):
+    """
+    Append entries to the archive, then mark their lines as belonging to it
+    so the next rewrite leaves them out of the database files. Lines already
+    in the archive (e.g. archived on another copy of the database and merged
+    back in) are not appended twice. Returns the number of entries archived.
+    """
+    if not entries:
+      return 0
+    try:
+      fp = open(self.archive_filename, 'rb+')
+    except FileNotFoundError:
+      fd = os.open(self.archive_filename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+      fp = os.fdopen(fd, 'rb+')
+      fp.write(self.FILE_HEADERS[self.format_version])
+    with fp:
+      fp.seek(0)
+      data = fp.read()
+      if not data.startswith(KoshDB.FILE_HEADERS):
+        raise ArchiveError('%s is not a kosh archive' % self.archive_filename)
+      end = data.rfind(b'\n') + 1
+      prefix = b''
+      if end < len(data):
+        if self._is_whole_line(data[end:]):
+          prefix = b'\n' # Only the newline is missing
+        else:
+          # Left by an append that was cut off. Those revisions stayed in
+          # the database files, so they will be archived again below.
+          fp.truncate(end)
+          data = data[:end]
+      known = set([line.strip() for line in data[len(KoshDB.FILE_HEADER):].splitlines()])
+      new = []
+      for entry in sorted(entries, key=lambda entry: entry._timestamp):
+        line = bytes(entry).strip()
+        if line not in known:
+          known.add(line)
+          new.append(line + b'\n')
+      if new:
+        self._append_to_fp(fp, prefix + b''.join(new))
+    ids = set([id(entry) for entry in entries])
+    self._lines = [(item, self.archive_filename if id(item) in ids else source)
+        for (item, source) in self._lines]
+    self.profile.count('revisions archived', len(entries))
+    return len(entries)
+
+  def has_archive(self):
+    """Return True if there is an archive that load_archive() has yet to read."""
+    return not self._archive_loaded and os.path.exists(self.archive_filename)
+
+  def load_archive(self):
+    """
+    Read the revisions compact() archived back into the history of their
+    entries, e.g. to look back further than the history read when the
+    database was opened. Lines no unlocked key can decrypt are skipped.
+    Returns False if there was no archive to load.
+    """
+    if not self.has_archive():
+      return False
+    self._archive_loaded = True
+    with self.profile.phase('load archive'):
+      try:
+        with open(self.archive_filename, 'rb') as fp:
+          data = fp.read()
+      except (IOError, OSError):
+        return False
+      if not data.startswith(KoshDB.FILE_HEADERS):
+        return False
+      known = set([(item if isinstance(item, bytes) else bytes(item)).strip()
+        for (item, source) in self._lines if source == self.archive_filename])
+      for line in data[len(KoshDB.FILE_HEADER):].splitlines(True):
+        stripped = line.strip()
+        if not line.endswith(b'\n') and not self._is_whole_line(line):
+          self._skip_incomplete_line(self.archive_filename)
+          break
+        if not stripped.startswith(passEntry.BLOB_PREFIXES) or stripped in known:
+          continue
+        known.add(stripped)
+        self._unresolved_p_lines.append((line, self.archive_filename, len(self._lines)))
+        self._lines.append((line, self.archive_filename))
+      self._resolve_p_lines()
+      # Anything left is kept in _lines as it is
+      self._unresolved_p_lines = []
+    return True
+
   # -------------------------------------------------------------------------
   # Key-source scanning (no passphrase/decryption; just discovers k: blobs)
   # -------------------------------------------------------------------------
@@ -552,20 +1622,20 @@ class KoshDB(dict):
     import io
     if visited is None:
       visited = set()
-    (data, error) = self._try_read_file(path)
+    (data, error) = self._read_source(path)
     if data is None:
       return [KeySource(KeySource.TYPE_UNAVAILABLE, path, error=error)]
     header_len = len(KoshDB.FILE_HEADER)
-    if data[:header_len] != KoshDB.FILE_HEADER:
+    if data[:header_len] not in KoshDB.FILE_HEADERS:
       return [KeySource(KeySource.TYPE_UNAVAILABLE, path,
                         error='Not a valid kosh key file')]
     return self._scan_fp_for_key_sources(io.BytesIO(data[header_len:]), path, visited)
 
-  def _scan_key_sources(self, filename):
+  def _scan_key_sources(self, filename, main_data):
     """
     Scan all auto-discovered key file locations for KeySource descriptors.
-    Returns (key_sources, visited_set).  Leaves self.fp positioned just
-    after the file header, ready for the full read phase.
+    main_data is the contents of the main database following the header.
+    Returns (key_sources, visited_set).
     """
     key_sources = []
     visited = set()
@@ -585,9 +1655,8 @@ class KoshDB(dict):
         key_sources.extend(self.scan_key_file(kf, visited))
 
     # Scan main db for k: entries (legacy single-file databases store k: here)
-    self.fp.seek(len(KoshDB.FILE_HEADER))
-    key_sources.extend(self._scan_fp_for_key_sources(self.fp, filename, visited))
-    self.fp.seek(len(KoshDB.FILE_HEADER))  # reset for full read phase
+    import io
+    key_sources.extend(self._scan_fp_for_key_sources(io.BytesIO(main_data), filename, visited))
 
     return key_sources, visited
 
@@ -596,21 +1665,28 @@ class KoshDB(dict):
   def _read_lines_from_fp(self, fp, source, passphrases, prompt, visited):
     """Read and process all lines from an open file pointer."""
     self._current_source = source
+    lineno = -1
     for lineno, line in enumerate(fp):
+      if not line.endswith(b'\n'):
+        # Only ever the last line. Every line is written with its newline, so
+        # this may be left from an append that was cut off:
+        if not self._is_whole_line(line):
+          self._skip_incomplete_line(source)
+          break
+        line += b'\n' # Also added to the file before appending after it
       if line.startswith(_masterKey.BLOB_PREFIX):
-        (key, passphrase) = self._unlockMasterKey(source, lineno, line, passphrases, prompt)
+        key = self._adopt_unlocked_key(source, lineno, line)
+        if key is None:
+          (key, passphrase) = self._unlockMasterKey(source, lineno, line, passphrases, prompt)
+          passphrases.add(passphrase)
         self._masterKeys.append(key)
-        passphrases.add(passphrase)
         self._lines.append((key, source))
-      elif line.startswith(passEntry.BLOB_PREFIX):
-        for key in self._masterKeys:
-          try:
-            entry = passEntry(key, line)
-          except ChecksumFailure:
-            continue
-          else:
-            self[entry.name] = entry
-            break
+      elif line.startswith(passEntry.BLOB_PREFIXES):
+        # In parallel mode every entry is deferred so they can be decrypted
+        # in bulk by _resolve_p_lines once all sources have been read.
+        entry = None if self._parallel() else self._decrypt_entry(line)
+        if entry is not None:
+          self[entry.name] = entry
         else:
           # No key could decrypt this entry yet; buffer it for a second attempt
           # once all key sources have been loaded (handles split databases where
@@ -622,6 +1698,10 @@ class KoshDB(dict):
           placeholder_idx = len(self._lines)
           self._lines.append((line, source))
           self._unresolved_p_lines.append((line, source, placeholder_idx))
+      elif line.startswith(self.SHARD_PREFIX):
+        # s: lines say how new entries are spread over shard files
+        self._lines.append((line, source))
+        self._shard_layout = self._parse_shard_line(line)
       elif line.startswith(self.REDIRECT_PREFIX):
         # r: lines point to additional key files (e.g. on a USB stick).
         # They are preserved verbatim and followed immediately.
@@ -636,6 +1716,11 @@ class KoshDB(dict):
         # Unrecognised entry - could be a comment, entry encoded by a different key, etc. whatever it is, don't lose it:
         self._lines.append((line, source))
     self._current_source = None
+    self.profile.count('lines read', lineno + 1)
+
+  def _skip_incomplete_line(self, source):
+    self.warnings.append('Ignored an incomplete line at the end of %s, left by'
+        ' an interrupted save' % source)
 
   @staticmethod
   def _is_windows_path(path):
@@ -643,92 +1728,207 @@ class KoshDB(dict):
     import re
     return bool(re.match(r'^[A-Za-z]:\\', path) or path.startswith('\\\\'))
 
-  @staticmethod
-  def _try_read_file(path):
+  def _read_source(self, path):
+    """
+    Read a key file or redirect target with _try_read_file(), at most once
+    per open. While opening, contents are kept in _read_cache by absolute
+    path along with the file's mtime and size, so the key scan and the full
+    read share one read (and on WSL one cmd.exe per Windows path). A file
+    that has changed in between is read again.
+    """
+    if self._read_cache is None:
+      return self._try_read_file(path)
+    abs_path = os.path.abspath(path)
+    try:
+      st = os.stat(path)
+      stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+      stamp = None # e.g. a Windows path that can only be read with cmd.exe
+    cached = self._read_cache.get(abs_path)
+    if cached is not None and cached[0] == stamp:
+      self.profile.count('read cache hits')
+      return cached[1]
+    result = self._try_read_file(path)
+    if result[0] is not None:
+      # Failures aren't cached, the file may turn up (e.g. a USB stick is
+      # plugged in) while the unlock dialog is open.
+      self._read_cache[abs_path] = (stamp, result)
+    return result
+
+  def _try_read_file(self, path):
     """
     Attempt to read a file, with a WSL2 cmd.exe fallback for Windows paths.
     Returns (data_bytes, error_str): data is None on failure, error is None on success.
     """
     import subprocess, version
-    try:
-      with open(path, 'rb') as f:
-        return (f.read(), None)
-    except (IOError, OSError) as e:
-      if version.is_wsl() and KoshDB._is_windows_path(path):
-        try:
-          result = subprocess.run(
-            ['cmd.exe', '/C', 'type', path],
-            capture_output=True,
-            timeout=5,
-          )
-          if result.returncode == 0 and result.stdout:
-            return (result.stdout, None)
-          return (None, 'cmd.exe could not read %s' % path)
-        except (OSError, subprocess.TimeoutExpired) as ce:
-          return (None, 'cmd.exe fallback failed for %s:\n%s' % (path, ce))
-      return (None, str(e))
+    with self.profile.phase('read file'):
+      try:
+        with open(path, 'rb') as f:
+          return (f.read(), None)
+      except (IOError, OSError) as e:
+        if version.is_wsl() and KoshDB._is_windows_path(path):
+          try:
+            with self.profile.phase('cmd.exe'):
+              result = subprocess.run(
+                ['cmd.exe', '/C', 'type', path],
+                capture_output=True,
+                timeout=5,
+              )
+            if result.returncode == 0 and result.stdout:
+              return (result.stdout, None)
+            return (None, 'cmd.exe could not read %s' % path)
+          except (OSError, subprocess.TimeoutExpired) as ce:
+            return (None, 'cmd.exe fallback failed for %s:\n%s' % (path, ce))
+        return (None, str(e))
 
   def _follow_redirect(self, path, abs_path, passphrases, prompt, visited):
     """Follow an r: redirect to another key file; silently skip if unavailable."""
     import io
-    (data, _err) = self._try_read_file(path)
-    if data is not None:
-      header_len = len(KoshDB.FILE_HEADER)
-      if data[:header_len] == KoshDB.FILE_HEADER:
-        visited.add(abs_path)
-        if self._is_windows_path(path):
-          self._readonly_sources.add(path)
-        self._read_lines_from_fp(io.BytesIO(data[header_len:]), path, passphrases, prompt, visited)
+    (data, _err) = self._read_source(path)
+    if data is not None and self._note_header(path, data):
+      visited.add(abs_path)
+      if self._is_windows_path(path):
+        self._readonly_sources.add(path)
+      self._read_lines_from_fp(io.BytesIO(data[len(KoshDB.FILE_HEADER):]), path, passphrases, prompt, visited)
+
+  @staticmethod
+  def _key_candidates(keys, hint, last_key=None):
+    """
+    Return keys in the order they should be tried for a p: or e: line. Lines
+    carrying a key hint go straight to the matching key; p: lines, which have
+    none, start with whichever key succeeded last since consecutive lines are
+    usually encrypted with the same key. The remaining keys are kept as a
+    fallback in case of a hint collision.
+    """
+    if hint is not None:
+      first = [key for key in keys if key.key_id() == hint]
+    elif last_key is not None and last_key in keys:
+      first = [last_key]
+    else:
+      return keys
+    return first + [key for key in keys if key not in first]
+
+  def _decrypt_entry(self, line):
+    """
+    Decrypt a p: line with whichever master key encrypted it, returning the
+    passEntry or None if no loaded key can decrypt it.
+    """
+    (hint, _blob, _body) = passEntry.split_blob(line)
+    for key in self._key_candidates(self._masterKeys, hint, self._last_key):
+      self.profile.count('decrypt attempts')
+      try:
+        entry = passEntry.from_line(key, line)
+      except ChecksumFailure:
+        continue
+      self._last_key = key
+      return entry
+    return None
+
+  def _decrypt_parallel(self, lines):
+    """
+    Decrypt p: lines across a pool of worker processes. Returns a list
+    parallel to lines of passEntry objects, or None where no key matched.
+    """
+    import concurrent.futures
+    raw_keys = [key._key for key in self._masterKeys]
+    chunk_size = max(64, -(-len(lines) // (self._jobs * 4)))
+    chunks = [lines[i:i+chunk_size] for i in range(0, len(lines), chunk_size)]
+    entries = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=self._jobs) as pool:
+      # map() yields results in submission order, keeping entries in file order
+      for (chunk, (results, attempts)) in zip(chunks, pool.map(_decrypt_p_lines,
+          [raw_keys]*len(chunks), chunks)):
+        self.profile.count('decrypt attempts', attempts)
+        for (line, (key_idx, contents)) in zip(chunk, results):
+          if key_idx is None:
+            entries.append(None)
+          else:
+            entries.append(passEntry.from_line(self._masterKeys[key_idx], line, contents=contents))
+    return entries
+
+  def _parallel(self):
+    """Return True if p: lines should be decrypted by the jobs pool."""
+    return bool(self._jobs) and self._opening
 
   def _resolve_p_lines(self):
     """Attempt to decrypt p: lines that were buffered due to no available master key."""
-    remaining = []
-    for (line, source, placeholder_idx) in self._unresolved_p_lines:
-      for key in self._masterKeys:
-        try:
-          entry = passEntry(key, line)
-        except ChecksumFailure:
+    with self.profile.phase('resolve'):
+      lines = [line for (line, source, placeholder_idx) in self._unresolved_p_lines]
+      if self._parallel() and len(lines) >= self.PARALLEL_MIN_LINES:
+        entries = self._decrypt_parallel(lines)
+      else:
+        entries = map(self._decrypt_entry, lines)
+      remaining = []
+      duplicates = set()
+      for ((line, source, placeholder_idx), entry) in zip(self._unresolved_p_lines, entries):
+        if entry is None:
+          remaining.append((line, source, placeholder_idx))
           continue
+        self._current_source = source
+        prev_len = len(self._lines)
+        self[entry.name] = entry
+        if len(self._lines) > prev_len:
+          # __setitem__ appended one entry; move it to the placeholder position
+          # so the resolved entry sits in the same file position as the original
+          # raw bytes, preserving the order of comment and unrecognised lines.
+          self._lines[placeholder_idx] = self._lines.pop()
         else:
-          self._current_source = source
-          prev_len = len(self._lines)
-          self[entry.name] = entry
-          if len(self._lines) > prev_len:
-            # __setitem__ appended one entry; move it to the placeholder position
-            # so the resolved entry sits in the same file position as the original
-            # raw bytes, preserving the order of comment and unrecognised lines.
-            self._lines[placeholder_idx] = self._lines.pop()
-          else:
-            # __setitem__ returned early (e.g. identical duplicate); the placeholder
-            # raw bytes at placeholder_idx are harmless — they'll be written back
-            # as-is, which is equivalent to the original unmodified line.
-            pass
-          self._current_source = None
-          break
-      else:
-        remaining.append((line, source, placeholder_idx))
-    self._unresolved_p_lines = remaining
+          # __setitem__ returned early (e.g. identical duplicate). Drop the
+          # placeholder, the same as if the line had been decrypted on the spot.
+          duplicates.add(placeholder_idx)
+        self._current_source = None
+      if duplicates:
+        # Removing placeholders shifts everything after them, so renumber the
+        # placeholders of any lines that are still unresolved.
+        new_idx = {}
+        lines = []
+        for (idx, item) in enumerate(self._lines):
+          if idx not in duplicates:
+            new_idx[idx] = len(lines)
+            lines.append(item)
+        self._lines = lines
+        remaining = [(line, source, new_idx[idx]) for (line, source, idx) in remaining]
+      self._unresolved_p_lines = remaining
 
   def _open(self, filename, prompt):
-    self._open_and_lock(filename)
-    self._readExpect(KoshDB.FILE_HEADER)
-    self._masterKeys = []
-    self._lines = []
-    self._oldEntries = []
-    self._unresolved_p_lines = []
-    self._readonly_sources = set()
-
-    if self._unlock_prompt is not None:
-      self._open_with_unlock_dialog(filename, prompt)
-    else:
-      self._open_legacy(filename, prompt)
+    self._opening = True
+    try:
+      self._open_and_lock(filename)
+      self.format_version = self._readHeader()
+      self._masterKeys = []
+      self._lines = []
+      self._oldEntries = []
+      self._unresolved_p_lines = []
+      self._readonly_sources = set()
+
+      if self._unlock_prompt is not None:
+        self._read_cache = {}
+        try:
+          self._open_with_unlock_dialog(filename, prompt)
+        finally:
+          self._read_cache = None # Don't hang on to file contents once open
+          for (blob, key) in self._unlocked_keys.values():
+            key.expire() # Unlocked in the dialog, but never read back in
+          self._unlocked_keys = {}
+      else:
+        self._open_legacy(filename, prompt)
+    finally:
+      self._opening = False
 
   def _open_with_unlock_dialog(self, filename, prompt):
     """
     New open flow: scan key sources, show unified unlock dialog, full read.
     """
+    # The main database is read once through the locked fp; the scan and the
+    # full read both work from these bytes.
+    main_data = self.fp.read()
+    if main_data.endswith(b'\n'):
+      # Otherwise the last line could be read again as new by reload()
+      self._mark_read(filename, self.fp, len(KoshDB.FILE_HEADER) + len(main_data), main_data)
+
     # Phase 1 — scan all known key file locations; no passphrase required.
-    (key_sources, _scan_visited) = self._scan_key_sources(filename)
+    with self.profile.phase('scan key sources'):
+      (key_sources, _scan_visited) = self._scan_key_sources(filename, main_data)
 
     # Phase 2 — show unlock dialog; loop until at least one key is unlocked
     # or the user cancels.  The dialog validates credentials itself via
@@ -736,16 +1936,19 @@ class KoshDB(dict):
     passphrases = set()
     extra_key_files = []   # user-added paths not saved as redirects
 
-    result = self._unlock_prompt(key_sources, self.scan_key_file)
+    with self.profile.phase('unlock prompt'): # Includes the time the user takes
+      result = self._unlock_prompt(key_sources, self.scan_key_file)
     if result is None:
       return  # user cancelled
 
-    (unlock_pairs, added_files) = result
+    (unlocked, added_files) = result
 
-    # Collect validated passphrases so the full-read phase can decrypt
-    # k: entries without re-prompting.
-    for (ks, credential) in unlock_pairs:
+    # Hand the keys the dialog unlocked to the full-read phase so their k:
+    # lines are not decrypted again, and collect the validated passphrases
+    # so it can decrypt any other k: entries without re-prompting.
+    for (ks, credential, key) in unlocked:
       passphrases.add(credential)
+      self._unlocked_keys[(os.path.abspath(ks.source_file), ks.lineno)] = (ks.blob, key)
 
     # Save any requested redirects BEFORE the full read so that
     # _get_key_files picks up the new <db>-redir.key file.
@@ -753,50 +1956,38 @@ class KoshDB(dict):
       expanded = os.path.expanduser(path)
       if self._is_windows_path(expanded):
         self._readonly_sources.add(expanded)
-      if remember:
+      if remember and not self.read_only:
         self._save_redirect(filename, path)
       else:
         extra_key_files.append(expanded)
 
     # Phase 3 — full read: populate _lines, _masterKeys, passEntries.
     # Use a fresh visited set so all files are read into _lines.
-    visited = set()
-    visited.add(os.path.abspath(filename))
-
-    # Read explicit (--keyfile) and user-added files via _try_read_file so that
-    # Windows paths (possible for user-added files) work via the cmd.exe fallback.
-    import io as _io
-    for key_filename in self._explicit_key_files + extra_key_files:
-      expanded = os.path.expanduser(key_filename)
-      abs_path = os.path.abspath(expanded)
-      if abs_path in visited:
-        continue
-      visited.add(abs_path)
-      (data, _err) = self._try_read_file(expanded)
-      if data is None:
-        continue
-      header_len = len(KoshDB.FILE_HEADER)
-      if data[:header_len] != KoshDB.FILE_HEADER:
-        continue
-      if self._is_windows_path(expanded):
-        self._readonly_sources.add(expanded)
-      self._read_lines_from_fp(_io.BytesIO(data[header_len:]), expanded, passphrases, prompt, visited)
-
-    for key_filename in self._get_key_files(filename):
-      abs_path = os.path.abspath(key_filename)
-      if abs_path in visited:
-        continue
-      visited.add(abs_path)
-      try:
-        with open(key_filename, 'rb') as kfp:
-          header = kfp.read(len(KoshDB.FILE_HEADER))
-          if header != KoshDB.FILE_HEADER:
-            continue
-          self._read_lines_from_fp(kfp, key_filename, passphrases, prompt, visited)
-      except (IOError, OSError):
-        pass
+    with self.profile.phase('read'):
+      visited = set()
+      visited.add(os.path.abspath(filename))
+
+      # Read explicit (--keyfile), user-added and auto-discovered key files.
+      # These come from the cache filled by the scan in phase 1 where
+      # possible. Windows paths (possible for user-added files) work via the
+      # cmd.exe fallback.
+      import io as _io
+      for key_filename in (self._explicit_key_files + extra_key_files +
+          self._get_key_files(filename)):
+        expanded = os.path.expanduser(key_filename)
+        abs_path = os.path.abspath(expanded)
+        if abs_path in visited:
+          continue
+        visited.add(abs_path)
+        (data, _err) = self._read_source(expanded)
+        if data is None or not self._note_header(expanded, data):
+          continue
+        if self._is_windows_path(expanded):
+          self._readonly_sources.add(expanded)
+        self._read_lines_from_fp(_io.BytesIO(data[len(KoshDB.FILE_HEADER):]), expanded, passphrases, prompt, visited)
 
-    self._read_lines_from_fp(self.fp, filename, passphrases, prompt, visited)
+      self._read_lines_from_fp(_io.BytesIO(main_data), filename, passphrases, prompt, visited)
+      self._read_shards(filename, passphrases, prompt, visited)
 
     if self._unresolved_p_lines:
       if self._masterKeys:
@@ -816,36 +2007,36 @@ class KoshDB(dict):
     visited = set()
     visited.add(os.path.abspath(filename))
 
-    for key_filename in self._explicit_key_files:
-      expanded = os.path.expanduser(key_filename)
-      abs_path = os.path.abspath(expanded)
-      if abs_path in visited:
-        continue
-      visited.add(abs_path)
-      try:
-        with open(expanded, 'rb') as kfp:
-          header = kfp.read(len(KoshDB.FILE_HEADER))
-          if header != KoshDB.FILE_HEADER:
-            continue
-          self._read_lines_from_fp(kfp, expanded, passphrases, prompt, visited)
-      except (IOError, OSError):
-        pass
-
-    for key_filename in self._get_key_files(filename):
-      abs_path = os.path.abspath(key_filename)
-      if abs_path in visited:
-        continue
-      visited.add(abs_path)
-      try:
-        with open(key_filename, 'rb') as kfp:
-          header = kfp.read(len(KoshDB.FILE_HEADER))
-          if header != KoshDB.FILE_HEADER:
-            continue
-          self._read_lines_from_fp(kfp, key_filename, passphrases, prompt, visited)
-      except (IOError, OSError):
-        pass
+    with self.profile.phase('read'):
+      for key_filename in self._explicit_key_files:
+        expanded = os.path.expanduser(key_filename)
+        abs_path = os.path.abspath(expanded)
+        if abs_path in visited:
+          continue
+        visited.add(abs_path)
+        try:
+          with open(expanded, 'rb') as kfp:
+            if not self._note_header(expanded, kfp.read(len(KoshDB.FILE_HEADER))):
+              continue
+            self._read_lines_from_fp(kfp, expanded, passphrases, prompt, visited)
+        except (IOError, OSError):
+          pass
+
+      for key_filename in self._get_key_files(filename):
+        abs_path = os.path.abspath(key_filename)
+        if abs_path in visited:
+          continue
+        visited.add(abs_path)
+        try:
+          with open(key_filename, 'rb') as kfp:
+            if not self._note_header(key_filename, kfp.read(len(KoshDB.FILE_HEADER))):
+              continue
+            self._read_lines_from_fp(kfp, key_filename, passphrases, prompt, visited)
+        except (IOError, OSError):
+          pass
 
-    self._read_lines_from_fp(self.fp, filename, passphrases, prompt, visited)
+      self._read_lines_from_fp(self.fp, filename, passphrases, prompt, visited)
+      self._read_shards(filename, passphrases, prompt, visited)
 
     if not self._masterKeys:
       self._request_key_file(filename, passphrases, prompt, visited)
@@ -885,20 +2076,19 @@ class KoshDB(dict):
       if data is None:
         error = 'Could not open %s:\n%s' % (expanded, read_error)
         continue
-      header_len = len(KoshDB.FILE_HEADER)
-      if data[:header_len] != KoshDB.FILE_HEADER:
+      if not self._note_header(expanded, data):
         error = 'Not a valid kosh key file:\n' + expanded
         continue
       visited.add(abs_path)
       if self._is_windows_path(expanded):
         self._readonly_sources.add(expanded)
-      self._read_lines_from_fp(io.BytesIO(data[header_len:]), expanded, passphrases, prompt, visited)
+      self._read_lines_from_fp(io.BytesIO(data[len(KoshDB.FILE_HEADER):]), expanded, passphrases, prompt, visited)
 
       if not self._masterKeys:
         error = 'No master key found in:\n' + expanded
         continue
 
-      if remember:
+      if remember and not self.read_only:
         self._save_redirect(db_filename, path)
 
   def _save_redirect(self, db_filename, key_path):
@@ -912,13 +2102,14 @@ class KoshDB(dict):
     key_filename = db_filename + '-redir.key'
     redirect_line = (self.REDIRECT_PREFIX.decode() + key_path.strip() + '\n').encode('utf-8')
 
-    # Read existing entries so they are preserved in the rewrite.
+    # Read existing entries so they are preserved in the rewrite, along
+    # with the version of its header, see _header_for().
     existing_lines = []
     if os.path.exists(key_filename):
       try:
         with open(key_filename, 'rb') as f:
           data = f.read()
-        if data[:len(self.FILE_HEADER)] == self.FILE_HEADER:
+        if self._note_header(key_filename, data):
           existing_lines = data[len(self.FILE_HEADER):].splitlines(keepends=True)
       except (IOError, OSError):
         pass
@@ -930,7 +2121,7 @@ class KoshDB(dict):
       os.makedirs(dirname, mode=0o700)
     with NamedTemporaryFile(mode='wb', delete=False,
         prefix=os.path.basename(key_filename), dir=dirname) as tmp:
-      tmp.write(self.FILE_HEADER)
+      tmp.write(self._header_for(key_filename))
       for line in existing_lines:
         tmp.write(line)
       tmp.write(redirect_line)
@@ -945,6 +2136,12 @@ class KoshDB(dict):
 
   def __setitem__(self, name, val):
     assert(name == val.name)
+    if self._current_source is None and val._format != self.format_version:
+      # New entries are saved in the format of the database
+      if val._timestamp is None:
+        val._format = self.format_version # Encrypted by timestamp() below
+      else:
+        val.reformat(self.format_version)
     val.timestamp()
     if 'RenamedFrom' in val.meta:
       oldname = val.meta['RenamedFrom']
@@ -952,13 +2149,19 @@ class KoshDB(dict):
         del val.meta['RenamedFrom']
     else:
       oldname = name
-    # FIXME: there is an edge case I haven't handled where renamed or deleted
-    # entries that have been stored out of order will not end up, so the old
-    # names may show up. There is a related edge case of any out of order
-    # entries causing the history to be out of order.
+    # Out of order revisions are sorted into the history, and revisions older
+    # than a later delete or rename are filed in the history of that name
+    # rather than bringing it back.
     # FIXME: Handle the edge case where one entry has been renamed over
     # another - it's valid, but be sure we don't lose the history of either
     # path
+    affected = (oldname, name)
+    replaced = [self.get(n) for n in affected]
+    self._merge(name, oldname, val)
+    self._update_indexes(affected, replaced)
+
+  def _merge(self, name, oldname, val):
+    """Merge val into the database, as found under oldname before any rename."""
     if oldname in self:
       if self[oldname] == val:
         return
@@ -974,14 +2177,143 @@ class KoshDB(dict):
       else:
         dict.__setitem__(self, name, new)
       self._oldEntries.append(old)
+    elif oldname in self._histories and not val >= self._histories[oldname].newest():
+      # An old revision of an entry that has since been deleted or renamed
+      # away, read out of order (e.g. after merging two files):
+      self._histories[oldname].merge(val._history_index())
+      self._oldEntries.append(val)
     else:
       if 'Deleted' in val.meta:
         # Edge case - deleting a non-(yet?)-existant entry
         self._oldEntries.append(val)
       dict.__setitem__(self, name, val)
-    # Track which file this entry belongs to; new entries go to the main db file
-    source = self._current_source if self._current_source is not None else self.filename
+    # Track which file this entry belongs to; new entries go to the main db
+    # file, or its shard if the database is sharded
+    source = self._current_source if self._current_source is not None else self._shard_for(name)
     self._lines.append((val, source))
+    if self._current_source is None:
+      # Not read from a source file, so it needs to be saved on the next write()
+      self._pending.append((val, source))
+
+  def _update_indexes(self, names, replaced):
+    """
+    Called after __setitem__ with the names it may have affected, and the
+    live entries that were under those names beforehand.
+    """
+    self.generation += 1
+    if self._change_log is not None:
+      self._change_log.update(names)
+    if self._index_changes is not None:
+      self._index_changes.update(names)
+    for name in names:
+      if name in self:
+        self._histories[name] = self[name]._history_index()
+    if self._content_index is not None:
+      for entry in replaced:
+        if entry is not None:
+          self._content_index.discard(entry.content_hash())
+      for name in names:
+        if name in self:
+          self._content_index.add(self[name].content_hash())
+    if self._search_index is not None:
+      self._index_names(self._search_index, names)
+
+  def _index_names(self, index, names):
+    """Bring the given names up to date in a search index."""
+    for name in names:
+      if name in self:
+        index.add(name, self[name])
+      else:
+        index.discard(name)
+
+  def _get_content_index(self):
+    """
+    Return the set of content hashes of all live entries, used to spot
+    duplicates when importing. Built the first time it is needed so that
+    opening the database doesn't pay for it, then kept up to date by
+    __setitem__.
+    """
+    if self._content_index is None:
+      self._content_index = set([entry.content_hash() for entry in self.values()])
+    return self._content_index
+
+  def search(self, query, within=None):
+    """
+    Return the set of names of live entries with query in their name or
+    any field other than the password, ignoring case. Terms can also be
+    scoped to a field, e.g. "url:example -user:^admin", see
+    search.parse_query(). within may be a set of names known to hold every
+    match, to narrow the search. The index this uses reveals every entry,
+    so it is built by start_search_index() or else the first time it is
+    needed, rather than when the database is opened. It is then kept up to
+    date by __setitem__.
+    """
+    return self._get_search_index().search(query, within)
+
+  def fuzzy_search(self, query, within=None, limit=None):
+    """
+    Fuzzy search for live entries holding the characters of query in order,
+    in their name or any field other than the password, ignoring case.
+    Returns (matches, best): the set of names of every match, and the names
+    of the limit (or all) best matches, best first. within is as for
+    search(). See search.trigramIndex.fuzzy().
+    """
+    return self._get_search_index().fuzzy(query, within, limit)
+
+  def start_search_index(self):
+    """
+    Start building the index used by search() on a background thread, e.g.
+    straight after opening the database in the UI, so that it is ready by
+    the time the first search is typed. The entries are only read on that
+    thread, and changes made while it runs are applied once it is done.
+    Entries of a K05Hv1 database whose fields are yet to be decrypted are
+    left to the first search to add the same way, since revealing them on
+    that thread would undo lazy loading, and is not thread safe.
+    If the build fails, the first search tries again on its own thread so
+    the error is raised there.
+    """
+    if self._search_index is not None or self._index_thread is not None:
+      return
+    import threading
+    entries = []
+    deferred = set()
+    for (name, entry) in self.items():
+      if isinstance(entry, lazyPassEntry):
+        deferred.add(name)
+      else:
+        entries.append((name, entry))
+    built = self._index_built = []
+    def build():
+      try:
+        built.append(self._build_search_index(entries))
+      except Exception:
+        pass
+    self._index_changes = deferred
+    self._index_thread = threading.Thread(target=build, name='kosh search index')
+    self._index_thread.daemon = True
+    self._index_thread.start()
+
+  @staticmethod
+  def _build_search_index(entries):
+    from .search import trigramIndex
+    index = trigramIndex()
+    for (name, entry) in entries:
+      index.add(name, entry)
+    return index
+
+  def _get_search_index(self):
+    if self._index_thread is not None:
+      with self.profile.phase('index wait'):
+        self._index_thread.join()
+      (built, changes) = (self._index_built, self._index_changes)
+      self._index_thread = self._index_built = self._index_changes = None
+      if built:
+        self._index_names(built[0], changes)
+        self._search_index = built[0]
+    if self._search_index is None:
+      with self.profile.phase('index'):
+        self._search_index = self._build_search_index(self.items())
+    return self._search_index
 
   def __delitem__(self, item):
     n = self[item.name].clone()
@@ -992,36 +2324,54 @@ class KoshDB(dict):
   @staticmethod
   def resolveConflict(entry1, entry2):
     (new,old) = [(entry1,entry2),(entry2,entry1)][entry2 >= entry1]
-    new.older = old
-    old.newer = new
-    # FIXME: Ensure entire chain is sorted
+    entry1._history_index().merge(entry2._history_index())
     return (new, old)
 
+  def _adopt_unlocked_key(self, source, lineno, blob):
+    """
+    Return the master key the unlock dialog already decrypted from this k:
+    line, or None. Keys are matched on the file and line number they were
+    scanned from, and only if the line itself is unchanged.
+    """
+    found = self._unlocked_keys.pop((os.path.abspath(source), lineno), None)
+    if found is None:
+      return None
+    (found_blob, key) = found
+    if found_blob.strip() != blob.strip(): # The newline may have been added, see _read_lines_from_fp()
+      key.expire()
+      return None
+    self.profile.count('keys adopted')
+    return key
+
   def _unlockMasterKey(self, source, lineno, blob, passphrases, prompt):
-    for passphrase in passphrases:
-      try:
-        key = _masterKey(passphrase, blob)
-      except ChecksumFailure:
-        pass
-      else:
-        return (key, passphrase)
-    while True:
-      linestr = ''
-      if lineno != 0:
-        linestr = ':%i' % lineno
-      passphrase = prompt('Passphrase error\n'
-          'Enter passphrase for %s%s:' % (source, linestr))
-      try:
-        key = _masterKey(passphrase, blob)
-      except ChecksumFailure:
-        continue
-      else:
-        return (key, passphrase)
+    with self.profile.phase('unlock master key'):
+      for passphrase in passphrases:
+        self.profile.count('passphrase attempts')
+        try:
+          key = _masterKey(passphrase, blob)
+        except ChecksumFailure:
+          pass
+        else:
+          return (key, passphrase)
+      while True:
+        linestr = ''
+        if lineno != 0:
+          linestr = ':%i' % lineno
+        passphrase = prompt('Passphrase error\n'
+            'Enter passphrase for %s%s:' % (source, linestr))
+        try:
+          key = _masterKey(passphrase, blob)
+        except ChecksumFailure:
+          continue
+        else:
+          return (key, passphrase)
 
-  def _readExpect(self, expect):
-    r = self.fp.read(len(expect))
-    if (r != expect):
+  def _readHeader(self):
+    """Read the file header of the main database, returning its format version."""
+    r = self.fp.read(len(KoshDB.FILE_HEADER))
+    if r not in KoshDB.FILE_HEADERS:
       raise Exception("Unrecognised file header")
+    return KoshDB.FILE_HEADERS.index(r)
 
   def change_passphrase(self, new_passphrase):
     """Re-encrypt writable master keys with a new passphrase.
@@ -1040,27 +2390,70 @@ class KoshDB(dict):
         '(Windows paths):\n' + '\n'.join(sorted(readonly_sources))
       )
     new_keys = [key.reencrypt(new_passphrase) for key in writable_keys]
+    self._needs_rewrite = True
     key_map = {id(old): new for old, new in zip(writable_keys, new_keys)}
     self._lines = [(key_map.get(id(item), item), src) for (item, src) in self._lines]
     for key in writable_keys:
       key.expire()
     self._masterKeys = [key_map.get(id(k), k) for k in self._masterKeys]
 
-  def importEntry(self, entry):
+  def _new_imported_entry(self, entry):
+    """
+    Create a passEntry from a dict of fields, with the name under 'name'. The
+    entry is left inside an uncommitted batch, so it won't be encrypted until
+    the caller commits it.
+    """
     newE = passEntry(self._masterKeys[0])
+    newE._format = self.format_version
+    newE.begin()
     for k in entry:
       if k == 'name':
         newE.name = entry[k]
       else:
         newE[k] = entry[k]
-    for e in self: # dict isn't hashable, so can't use in without implementing __hash__ in a reliable manner
-      if newE == self[e]:
-        return False
+    return newE
+
+  def importEntry(self, entry):
+    newE = self._new_imported_entry(entry)
+    if newE.content_hash() in self._get_content_index():
+      return False
     if not newE.name:
       raise Exception('No name on imported entry, not importing')
+    newE.commit()
     self[newE.name] = newE
     return True
 
+  def bulkImport(self, entries, progress=None):
+    """
+    Import an iterable of dicts as taken by importEntry(), skipping any that
+    are identical to an existing entry or an earlier one in the same import.
+    Each new entry is encrypted exactly once, and the database is written
+    once at the end. progress(entry, imported) is called for every entry if
+    provided. Returns the number of entries imported.
+    """
+    index = self._get_content_index()
+    imported = 0
+    try:
+      for entry in entries:
+        newE = self._new_imported_entry(entry)
+        if newE.content_hash() in index:
+          # Never committed, so never encrypted
+          if progress is not None:
+            progress(newE, False)
+          continue
+        if not newE.name:
+          raise Exception('No name on imported entry, not importing')
+        newE.timestamp()
+        newE.commit()
+        self[newE.name] = newE # Adds it to the index
+        imported += 1
+        if progress is not None:
+          progress(newE, True)
+    finally:
+      if imported:
+        self.write()
+    return imported
+
 if __name__ == '__main__':
   import tempfile
   filename = tempfile.mktemp()
@@ -1070,9 +2463,10 @@ if __name__ == '__main__':
     db = KoshDB(filename, prompt)
     e = passEntry(db._masterKeys[0]) # FIXME: Doing this creates a strong reference to the master key - timers will not automatically be destroyed
     e['foo'] = 'bar'
-    print(e._blob)
+    e.timestamp()
+    print(bytes(e))
 
-    d = passEntry(db._masterKeys[0], passEntry.BLOB_PREFIX + e._blob)
+    d = passEntry.from_line(db._masterKeys[0], bytes(e))
     print(d['foo'])
     del e
     del d
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Merge kosh database and key files. Every line of a kosh file stands on its
+own, so merging diverged copies is a matter of keeping one copy of each
+unique line. The inputs are streamed, so memory use grows with a short
+digest per unique line rather than with the size of the files, and entries
+are never held decrypted any longer than it takes to verify or migrate them
+between file format versions.
+"""
+
+import os
+import errno
+import hashlib
+from .koshdb import KoshDB, passEntry, _masterKey, ChecksumFailure, FileLocked
+
+class MergeError(Exception): pass
+
+LINE_DIGEST_SIZE = 16 # bytes, enough that distinct lines never collide in practice
+
+def _check_header(fp, filename):
+  """Read the header of a kosh file, returning its format version."""
+  header = fp.read(len(KoshDB.FILE_HEADER))
+  if header not in KoshDB.FILE_HEADERS:
+    raise MergeError('%s is not a kosh database or key file' % filename)
+  return KoshDB.FILE_HEADERS.index(header)
+
+def format_version(filename):
+  """Return the format version of a kosh file from its header."""
+  with open(filename, 'rb') as fp:
+    return _check_header(fp, filename)
+
+def read_lines(filename):
+  """Yield (lineno, line) for the lines of a kosh file following its header."""
+  with open(filename, 'rb') as fp:
+    _check_header(fp, filename)
+    for (lineno, line) in enumerate(fp, 1):
+      yield (lineno, line)
+
+def is_format(line, version):
+  """
+  Return True if the p: or e: line is a record as written in files of the
+  given format version.
+  """
+  return line.startswith(passEntry.BLOB_PREFIXES[version])
+
+def unlock_keys(filenames, prompt):
+  """
+  Unlock the k: lines of the given files for verify(). prompt(message) is
+  asked for a passphrase, which is tried on every key before asking again.
+  A key is skipped if prompt returns an empty passphrase for it.
+  """
+  keys = []
+  blobs = set()
+  passphrases = []
+  for filename in filenames:
+    for (lineno, line) in read_lines(filename):
+      line = line.strip()
+      if not line.startswith(_masterKey.BLOB_PREFIX) or line in blobs:
+        continue
+      blobs.add(line)
+      key = None
+      for passphrase in passphrases:
+        try:
+          key = _masterKey(passphrase, line)
+          break
+        except ChecksumFailure:
+          pass
+      while key is None:
+        passphrase = prompt('Passphrase for %s:%i:' % (filename, lineno))
+        if not passphrase:
+          break
+        try:
+          key = _masterKey(passphrase, line)
+          passphrases.append(passphrase)
+        except ChecksumFailure:
+          pass
+      if key is not None:
+        keys.append(key)
+  return keys
+
+class verifier(object):
+  """
+  Checks that p: and e: lines can be decrypted by one of a list of master
+  keys. Each entry is decrypted in full, including authenticating the body
+  of e: lines along with their head, then thrown away.
+  """
+  def __init__(self, keys):
+    self.keys = keys
+    self._last_key = None
+
+  def decrypt(self, line):
+    """Return the passEntry for line, or None if no key can decrypt it."""
+    (hint, _blob, _body) = passEntry.split_blob(line)
+    for key in KoshDB._key_candidates(self.keys, hint, self._last_key):
+      try:
+        entry = passEntry.from_line(key, line)
+        len(entry) # Reveals the body of a lazily loaded entry, authenticating it
+      except (ChecksumFailure, ValueError):
+        continue
+      self._last_key = key
+      return entry
+    return None
+
+  def __call__(self, line):
+    return self.decrypt(line) is not None
+
+class converter(verifier):
+  """
+  Migrates p: and e: lines to the record format of another file format
+  version, returning the new line or None if no key can decrypt it. e:
+  lines are sealed deterministically (see _masterKey.seal()), so copies of
+  a database migrated separately still merge line for line.
+  """
+  def __init__(self, keys, format_version):
+    verifier.__init__(self, keys)
+    self.format_version = format_version
+
+  def __call__(self, line):
+    entry = self.decrypt(line)
+    if entry is None:
+      return None
+    entry.reformat(self.format_version, deterministic=True)
+    return bytes(entry)
+
+def merge(filenames, out, verify=None, convert=None, version=None):
+  """
+  Write a header and the unique lines of the given files to the binary file
+  object out, in the order they are first seen. Lines are compared and
+  written with surrounding whitespace (e.g. \\r\\n line endings) stripped,
+  and blank lines are dropped.
+
+  The header is for format version, or the newest version of the inputs.
+  If convert is given (a converter for that version), entries in the other
+  record format (see is_format()) are migrated with it. If verify is given
+  (e.g. a verifier), it is called with every other entry.
+  Entries that fail either are still written as they are so nothing is
+  lost, but reported back. Returns (lines written, list of (filename,
+  lineno) of lines that failed).
+  """
+  if version is None:
+    version = max([format_version(filename) for filename in filenames])
+  out.write(KoshDB.FILE_HEADERS[version])
+  seen = set()
+  def first_seen(line):
+    digest = hashlib.blake2b(line, digest_size=LINE_DIGEST_SIZE).digest()
+    if digest in seen:
+      return False
+    seen.add(digest)
+    return True
+  written = 0
+  failed = []
+  for filename in filenames:
+    for (lineno, line) in read_lines(filename):
+      line = line.strip()
+      if not line or not first_seen(line):
+        continue
+      if line.startswith(passEntry.BLOB_PREFIXES):
+        if convert is not None and not is_format(line, version):
+          converted = convert(line)
+          if converted is None:
+            failed.append((filename, lineno))
+          elif not first_seen(converted):
+            continue # Already migrated on another copy of the database
+          else:
+            line = converted
+        elif verify is not None and not verify(line):
+          failed.append((filename, lineno))
+      out.write(line + b'\n')
+      written += 1
+  return (written, failed)
+
+def check_not_open(filename):
+  """
+  Raise FileLocked if kosh has filename open, since merging over the top of
+  it would be undone the next time that instance saves.
+  """
+  try:
+    import fcntl
+  except ImportError:
+    # Windows: an instance holding the lock file open stops it being removed
+    lock_filename = filename+'.lock'
+    if os.path.exists(lock_filename):
+      try:
+        os.remove(lock_filename)
+      except PermissionError:
+        raise FileLocked()
+    return
+  try:
+    fp = open(filename, 'rb+')
+  except FileNotFoundError:
+    return
+  with fp:
+    try:
+      fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+      if e.errno not in (errno.EACCES, errno.EAGAIN):
+        raise
+      raise FileLocked()
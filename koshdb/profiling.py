@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Opt-in instrumentation of where the time goes when opening and saving a
+database. KoshDB reports to a nullProfile unless it is given a
+sessionProfile, which records the wall time of each phase along with
+counters such as lines read and decrypt attempts, and writes them out as a
+JSON report at the end of the session. Reports hold no entry names, field
+contents or paths, so they can be shared when chasing a slow unlock.
+"""
+
+import time
+import json
+import contextlib
+import collections
+import threading
+
+class nullProfile(object):
+  """Records nothing, so instrumentation is close to free when not wanted."""
+  def phase(self, name):
+    return contextlib.nullcontext()
+
+  def count(self, name, n=1):
+    pass
+
+class sessionProfile(nullProfile):
+  def __init__(self, filename):
+    self.filename = filename
+    self.started = time.time()
+    self.phases = collections.OrderedDict() # path -> [calls, seconds]
+    self.counters = collections.Counter()
+    self._local = threading.local() # Phases nest per thread
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    """
+    Time the body of a with statement. Nested phases are recorded under the
+    path of the phases enclosing them, e.g. open/read/unlock master key.
+    """
+    stack = self._local.__dict__.setdefault('stack', [])
+    stack.append(name)
+    path = '/'.join(stack)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      stack.pop()
+      stats = self.phases.setdefault(path, [0, 0.0])
+      stats[0] += 1
+      stats[1] += elapsed
+
+  def count(self, name, n=1):
+    self.counters[name] += n
+
+  def report(self):
+    return {
+      'started': self.started,
+      'duration': time.time() - self.started,
+      'phases': collections.OrderedDict([(path, {'calls': calls, 'seconds': seconds})
+        for (path, (calls, seconds)) in self.phases.items()]),
+      'counters': dict(self.counters),
+    }
+
+  def write(self):
+    with open(self.filename, 'w') as fp:
+      json.dump(self.report(), fp, indent=2)
+      fp.write('\n')
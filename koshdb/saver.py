@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Save a KoshDB on a background thread, so that a slow disk (e.g. a network
+home directory) doesn't freeze the UI while the files are written, synced
+and renamed into place.
+"""
+
+import threading
+import time
+
+class writeBehind(object):
+  """
+  Saves db on a background thread whenever save() is called. A save starts
+  once delay seconds have passed without another being requested, and saves
+  requested while another is running wait for it to finish, so a burst of
+  changes is coalesced into a single save that picks up all of them.
+
+  KoshDB is not thread safe, so anything that modifies db (or reads it in a
+  way that touches its files, e.g. reload()) must hold lock while it does.
+
+  notify(event, detail) is called on the saver thread when a save starts
+  ('saving'), finishes ('saved') or fails ('error', detail being the
+  exception), so it should only hand the event over to the UI thread. A
+  failed save leaves the changes pending, so they are retried by the next
+  save, or by flush().
+  """
+  def __init__(self, db, notify=None, delay=0.25):
+    self.db = db
+    self.notify = notify
+    self.delay = delay
+    self.lock = threading.RLock()
+    self.error = None
+    self._cond = threading.Condition()
+    self._requested = None # None, 'write' or 'compact'
+    self._due = 0
+    self._saving = False
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name='kosh saver')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def save(self, compact=False):
+    """Save db in the background, rewriting it in full if compact is True."""
+    with self._cond:
+      if compact or self._requested is None:
+        self._requested = compact and 'compact' or 'write'
+      self._due = time.time() + self.delay
+      self._cond.notify()
+
+  def busy(self):
+    """Return True if a save is running or waiting to run."""
+    with self._cond:
+      return self._saving or self._requested is not None
+
+  def flush(self):
+    """
+    Wait for any outstanding save to finish. If the last save failed it is
+    retried on this thread, so the exception is raised to the caller rather
+    than the changes being silently lost.
+    """
+    with self._cond:
+      self._due = 0 # Don't wait out the delay
+      self._cond.notify_all()
+      while self._saving or self._requested is not None:
+        self._cond.wait()
+      error = self.error
+    if error is not None:
+      with self.lock:
+        self.db.write() # Also finishes a failed compact, see KoshDB.compact()
+      self.error = None
+
+  def close(self):
+    """Flush, then stop the saver thread."""
+    try:
+      self.flush()
+    finally:
+      with self._cond:
+        self._closed = True
+        self._cond.notify()
+      self._thread.join()
+
+  def _notify(self, event, detail=None):
+    if self.notify is not None:
+      self.notify(event, detail)
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while True:
+          if self._requested is None:
+            if self._closed:
+              return
+            self._cond.wait()
+            continue
+          remaining = self._due - time.time()
+          if remaining <= 0:
+            break
+          self._cond.wait(remaining)
+        compact = self._requested == 'compact'
+        self._requested = None
+        self._saving = True
+      self._notify('saving')
+      error = None
+      try:
+        with self.lock:
+          if compact:
+            self.db.compact()
+          else:
+            self.db.write()
+      except Exception as e:
+        error = e
+      with self._cond:
+        self._saving = False
+        self.error = error
+        self._cond.notify_all()
+      if error is None:
+        self._notify('saved')
+      else:
+        self._notify('error', error)
@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Indexes for searching the entries of a KoshDB, see KoshDB.search().
+"""
+
+import heapq
+import re
+import sys
+
+NGRAM = 3
+FIELD_SEPARATOR = '\0' # Between the fields of an entry in its indexed text
+# FIXME: Don't (optionally?) search on other protected fields
+UNSEARCHABLE_FIELDS = ('password',)
+
+# Scoped queries, see parse_query()
+NAME_FIELD = 'name'
+FIELD_ALIASES = {
+  'user': 'username',
+  'login': 'username',
+  'note': 'notes',
+}
+TOKEN_RE = re.compile(r'(?:[^\s"]|"[^"]*"?)+')
+
+# Fuzzy match scoring, loosely after fzf
+SCORE_MATCH = 16
+SCORE_GAP_START = -3
+SCORE_GAP_EXTENSION = -1
+BONUS_BOUNDARY = 8 # Matched the start of a word
+BONUS_CONSECUTIVE = 4 # Matched straight after the previous character
+BONUS_FIRST_CHAR_MULTIPLIER = 2
+BONUS_PREFIX = 16 # The query is a prefix of the field
+BONUS_NAME = 24 # Matched the name rather than a field
+FUZZY_SCORED_PER_RESULT = 4 # Most matches fuzzy() scores per result it lists
+
+def ngrams(text, n=NGRAM):
+  """Return the set of substrings of length n in text."""
+  return set([text[i:i+n] for i in range(len(text) - n + 1)])
+
+def charmask(text):
+  """
+  Return a bitmask of the characters in text. A text can only hold a query
+  as a subsequence if its mask has every bit of the query's mask set.
+  """
+  mask = 0
+  for c in set(text):
+    o = ord(c)
+    mask |= 1 << (o if o < 128 else 128 + o % 64) # One bit per ASCII character
+  return mask
+
+def best_score(length):
+  """The highest score fuzzy_score() can give a query of length characters."""
+  return (length * (SCORE_MATCH + BONUS_BOUNDARY) + BONUS_PREFIX +
+      BONUS_BOUNDARY * (BONUS_FIRST_CHAR_MULTIPLIER - 1))
+
+def _word_start(c):
+  """Regex for c where fuzzy_score() counts it as starting a word."""
+  before = r'\d' if c.isdigit() else r'[^\W\d_]' # Any letter
+  # Checked behind c, so that searches can still skip ahead to c itself
+  return '%s(?<!%s%s)' % (re.escape(c), before, re.escape(c))
+
+def fuzzy_pattern(query, word_start=False):
+  """
+  Compile a regex finding the characters of query in order within one
+  field, the first starting a word if word_start. Each gap runs up to the
+  first of the next character, which finds the same match as a lazy gap
+  would, but a failed attempt doesn't backtrack through every other way of
+  placing the characters before it.
+  """
+  if not query:
+    return re.compile('')
+  parts = [_word_start(query[0]) if word_start else re.escape(query[0])]
+  for c in query[1:]:
+    c = re.escape(c)
+    parts.append('[^%s%s]*%s' % (c, FIELD_SEPARATOR, c))
+  return re.compile(''.join(parts))
+
+def word_start_pattern(query):
+  """Compile a regex finding query where fuzzy_score() counts it as starting a word."""
+  return re.compile(_word_start(query[:1]) + re.escape(query[1:]))
+
+def fuzzy_score(query, text, pattern=None):
+  """
+  Score how well the characters of query appear in order in one of the
+  FIELD_SEPARATOR separated fields of text (both lowercased), or return
+  None if they don't. The first field they appear in is scored, over the
+  shortest window holding them, rewarding characters that start words,
+  follow on from the previous one or start the field, and penalising gaps.
+  pattern is fuzzy_pattern(query), to save looking it up on every call.
+  """
+  if pattern is None:
+    pattern = fuzzy_pattern(query)
+  m = pattern.search(text)
+  if m is None:
+    return None
+  # Work back from the end of the match to where it could start latest
+  rfind = text.rfind
+  field_start = rfind(FIELD_SEPARATOR, 0, m.start()) + 1
+  start = m.end()
+  for c in reversed(query):
+    start = rfind(c, field_start, start)
+  find = text.find
+  score = 0
+  prev = None
+  pos = start - 1
+  for c in query:
+    pos = find(c, pos + 1)
+    bonus = 0
+    if pos == 0 or not text[pos-1].isalnum() or text[pos-1].isdigit() != text[pos].isdigit():
+      bonus = BONUS_BOUNDARY
+    if prev is None:
+      bonus *= BONUS_FIRST_CHAR_MULTIPLIER
+    elif pos == prev + 1:
+      bonus = max(bonus, BONUS_CONSECUTIVE)
+    else:
+      score += SCORE_GAP_START + SCORE_GAP_EXTENSION * (pos - prev - 2)
+    score += SCORE_MATCH + bonus
+    prev = pos
+  if start == field_start and text.startswith(query, start):
+    score += BONUS_PREFIX
+  return score
+
+def name_order(name):
+  """Sort key listing names alphabetically ignoring case, then by case."""
+  return (name.lower(), name)
+
+class _lastFirst(object):
+  """
+  Wraps a name so that it sorts before the names it would be listed after
+  by name_order(), which makes the worst of equal scores in the heap of
+  trigramIndex.fuzzy() the one listed last.
+  """
+  __slots__ = ('name', 'order')
+  def __init__(self, name):
+    self.name = name
+    self.order = name_order(name)
+
+  def __lt__(self, other):
+    return self.order > other.order
+
+class queryTerm(object):
+  """
+  One term of a scoped query, see parse_query(). field is the lowercased
+  field name, NAME_FIELD for the entry name, or None for any field.
+  """
+  def __init__(self, text, field=None, negate=False, anchor_start=False, anchor_end=False):
+    self.text = text
+    self.field = field
+    self.negate = negate
+    self.anchor_start = anchor_start
+    self.anchor_end = anchor_end
+
+  def matches(self, text):
+    """Return True if the lowercased text matches this term."""
+    if self.anchor_start and self.anchor_end:
+      return text == self.text
+    if self.anchor_start:
+      return text.startswith(self.text)
+    if self.anchor_end:
+      return text.endswith(self.text)
+    return self.text in text
+
+def parse_query(query, is_field):
+  """
+  Parse a search made up of whitespace separated terms that must all
+  match, where:
+
+    text          has text in its name or any field
+    field:text    has text in that field (name: for the entry name)
+    field:^text   that field starts with text, or ends with it for text$
+    -term         does not match term
+
+  Double quotes group text containing spaces, e.g. notes:"old server".
+  Fields are matched ignoring case, and FIELD_ALIASES may be used for the
+  common ones. is_field(field) tells whether a lowercased field name is
+  one that is searched, so that an unscoped search for e.g. a URL isn't
+  taken to be scoped to a field named "https".
+
+  Returns a list of queryTerm, or None if query has no scoped or negated
+  terms, in which case it should be searched for as it is, spaces and all.
+  """
+  terms = []
+  scoped = False
+  for token in TOKEN_RE.findall(query.lower()):
+    negate = len(token) > 1 and token.startswith('-')
+    if negate:
+      token = token[1:]
+    (field, sep, text) = token.partition(':')
+    field = field.replace('"', '')
+    field = FIELD_ALIASES.get(field, field)
+    if sep and (field == NAME_FIELD or is_field(field)):
+      anchor_start = text.startswith('^')
+      if anchor_start:
+        text = text[1:]
+      anchor_end = text.endswith('$')
+      if anchor_end:
+        text = text[:-1]
+      terms.append(queryTerm(text.replace('"', ''), field, negate, anchor_start, anchor_end))
+      scoped = True
+    else:
+      terms.append(queryTerm(token.replace('"', ''), None, negate))
+      scoped = scoped or negate
+  if not scoped:
+    return None
+  return terms
+
+class ngramIndex(object):
+  """
+  Inverted index from the trigrams of some lowercased texts held under each
+  name to the names holding them. A substring search then only has to
+  check the names holding every trigram of the query, rather than scanning
+  every text. Queries shorter than a trigram fall back to scanning.
+
+  The names holding a trigram are only found the first time it is searched
+  for, by scanning the texts for it, and kept up to date from then on.
+  Adding a name just stores its texts, so indexing a large database is
+  quick, and only the trigrams that are actually searched for take memory.
+  """
+  def __init__(self):
+    self._texts = {} # name -> tuple of lowercased texts
+    self._postings = {} # trigram searched for so far -> set of names
+
+  def __len__(self):
+    return len(self._texts)
+
+  def __contains__(self, name):
+    return name in self._texts
+
+  def add(self, name, texts):
+    """Index the strings texts under name, replacing anything already there."""
+    self.discard(name)
+    self._store(name, tuple([text.lower() for text in texts]))
+
+  def _store(self, name, texts):
+    """Hold the tuple of lowercased texts under a name not yet indexed."""
+    self._texts[name] = texts
+    for (gram, names) in self._postings.items():
+      for text in texts:
+        if gram in text:
+          names.add(name)
+          break
+
+  def discard(self, name):
+    if self._texts.pop(name, None) is None:
+      return
+    for names in self._postings.values():
+      names.discard(name)
+
+  def _posting(self, gram):
+    """Return the set of names holding gram, scanning for them the first time."""
+    names = self._postings.get(gram)
+    if names is None:
+      names = set([name for (name, texts) in self._texts.items() for text in texts if gram in text])
+      self._postings[gram] = names
+    return names
+
+  def candidates(self, query, scan=True):
+    """
+    Return the set of names that may contain the lowercased query, or None
+    if it is too short to narrow them down. Only the trigrams searched for
+    before are used, plus one more if none of them have been and scan is
+    True, so a query costs at most one scan of the texts.
+    """
+    grams = ngrams(query)
+    if not grams:
+      return None
+    postings = [self._postings[gram] for gram in grams if gram in self._postings]
+    if not postings:
+      if not scan:
+        return None
+      postings = [self._posting(min(grams))]
+    postings.sort(key=len)
+    result = set(postings[0])
+    for names in postings[1:]:
+      result.intersection_update(names)
+      if not result:
+        break
+    return result
+
+  def _narrow(self, query, within):
+    """The names search() has to check for query."""
+    # Checking within is no more work than scanning the texts for a trigram
+    candidates = self.candidates(query, scan=within is None)
+    if within is not None and (candidates is None or len(within) < len(candidates)):
+      return within
+    if candidates is None:
+      return self._texts
+    return candidates
+
+  def search(self, query, within=None):
+    """
+    Return the set of names with query in any of their texts, ignoring
+    case. within may be a set of names known to hold every match, e.g. the
+    matches of a query that this one extends, which are checked instead of
+    the candidates from the index if there are fewer of them.
+    """
+    return self.search_term(queryTerm(query.lower()), within)
+
+  def search_term(self, term, within=None):
+    """Return the set of names with a text matching the queryTerm term."""
+    texts = self._texts
+    result = set()
+    query = term.text
+    anchored = term.anchor_start or term.anchor_end
+    for name in self._narrow(query, within):
+      for text in texts.get(name, ()):
+        if (term.matches(text) if anchored else query in text):
+          result.add(name)
+          break
+    return result
+
+class trigramIndex(ngramIndex):
+  """
+  Search index over the names and searchable fields of the entries of a
+  database. The text of each entry is kept lowercased, with its fields
+  joined into one string, so checking the candidates for a query is a
+  couple of substring tests.
+
+  Each field is also indexed on its own by an ngramIndex, so that a query
+  scoped to a field by parse_query() syntax only checks that field, of the
+  entries that have it. These are built the first time a query is scoped
+  to their field, since most are never searched on their own, and kept up
+  to date from then on. A charmask() of each entry is kept as well, so
+  fuzzy() can skip entries that lack a character of the query without
+  looking at their text.
+  """
+  def __init__(self):
+    ngramIndex.__init__(self)
+    # _texts holds (lowercased name, lowercased fields joined by FIELD_SEPARATOR)
+    self._masks = {} # name -> charmask() of its texts
+    self._entry_fields = {} # name -> lowercased names of its fields, in the order of its text
+    self._field_counts = {} # lowercased field name -> number of entries with it
+    self._fields = {} # lowercased field name -> ngramIndex of its values, see _field_index()
+
+  def add(self, name, fields):
+    """
+    Index name and its fields, a dict of field name -> value, replacing
+    anything already there.
+    """
+    self.discard(name)
+    keys = []
+    values = []
+    for (key, value) in fields.items():
+      key = sys.intern(key.lower())
+      if key not in UNSEARCHABLE_FIELDS:
+        keys.append(key)
+        values.append(value.replace(FIELD_SEPARATOR, ' ').lower())
+    texts = (name.lower(), FIELD_SEPARATOR.join(values))
+    self._store(name, texts)
+    self._masks[name] = charmask(texts[0] + texts[1])
+    self._entry_fields[name] = keys = tuple(keys)
+    for key in set(keys):
+      self._field_counts[key] = self._field_counts.get(key, 0) + 1
+      if key in self._fields:
+        self._fields[key].add(name, self._field_values(name, key))
+
+  def _field_values(self, name, field):
+    """Return the lowercased values of a field of an indexed entry."""
+    values = self._texts[name][1].split(FIELD_SEPARATOR)
+    return [value for (key, value) in zip(self._entry_fields[name], values) if key == field]
+
+  def discard(self, name):
+    if name not in self._texts:
+      return
+    ngramIndex.discard(self, name)
+    del self._masks[name]
+    for key in set(self._entry_fields.pop(name)):
+      self._field_counts[key] -= 1
+      if not self._field_counts[key]:
+        del self._field_counts[key]
+        self._fields.pop(key, None)
+      elif key in self._fields:
+        self._fields[key].discard(name)
+
+  def _is_field(self, field):
+    return field in self._field_counts
+
+  def _field_index(self, field):
+    """Return the ngramIndex of a lowercased field name, building it if need be."""
+    index = self._fields.get(field)
+    if index is None:
+      index = ngramIndex()
+      for (name, keys) in self._entry_fields.items():
+        if field in keys:
+          index.add(name, self._field_values(name, field))
+      self._fields[field] = index
+    return index
+
+  def search(self, query, within=None):
+    """
+    Return the set of names matching query, ignoring case. A query in
+    parse_query() syntax is evaluated term by term. Anything else matches
+    entries with the whole query in their name or any field.
+
+    within may be a set of names known to hold every match, e.g. the
+    matches of a query that this one extends, which are checked instead of
+    the candidates from the index if there are fewer of them. It is ignored
+    for scoped queries, since adding to one doesn't always narrow it down
+    (e.g. extending "url" to "url:x").
+    """
+    terms = parse_query(query, self._is_field)
+    if terms is None:
+      return self.search_term(queryTerm(query.lower()), within)
+    # Narrow down by the terms that must match first, scoped ones (checking
+    # less text) before the rest, then weed out those that mustn't
+    terms.sort(key=lambda term: (term.negate, term.field is None))
+    result = None
+    for term in terms:
+      if term.negate:
+        if result is None:
+          result = set(self._texts)
+        result.difference_update(self._search_scoped(term, result))
+      else:
+        result = self._search_scoped(term, result)
+      if not result:
+        break
+    return result
+
+  def _search_scoped(self, term, within):
+    """Return the set of names matching the queryTerm term, ignoring negate."""
+    if term.field is None:
+      return self.search_term(term, within)
+    if term.field == NAME_FIELD:
+      names = set()
+      texts = self._texts
+      for name in self._narrow(term.text, within):
+        if name in texts and term.matches(texts[name][0]):
+          names.add(name)
+      return names
+    if not self._is_field(term.field):
+      return set()
+    return self._field_index(term.field).search_term(term, within)
+
+  def fuzzy(self, query, within=None, limit=None):
+    """
+    Fuzzy search for entries holding the characters of query in order, in
+    their name or one of their fields, ignoring case. Returns (matches,
+    best): the set of names of every such entry, and the names of the limit
+    (or all) that score best by fuzzy_score(), best first. Matches in the
+    name score BONUS_NAME higher. within may narrow down the names to
+    check, as for search(), since entries that don't match a query can't
+    match any query extending it either.
+
+    Finding the matches is left to a regex, and matches that can no longer
+    make it into the best are not scored. Equal scores are listed by
+    name_order(), so the best don't depend on the order names were indexed
+    in. If there are more than FUZZY_SCORED_PER_RESULT matches in the name
+    (or fields) per result to list, only that many are scored, see
+    _most_promising(), so a short query matching most of a large database
+    doesn't score all of them.
+    """
+    if parse_query(query, self._is_field) is not None:
+      # Scoped queries only match substrings, so are listed by name
+      matches = self.search(query)
+      return (matches, heapq.nsmallest(limit or len(matches), matches, key=name_order))
+    query = query.lower()
+    pattern = fuzzy_pattern(query)
+    search = pattern.search
+    qmask = charmask(query)
+    masks = self._masks
+    texts = self._texts
+    if within is None:
+      names = [name for (name, mask) in masks.items() if mask & qmask == qmask]
+    else:
+      names = [name for name in within if name in masks and masks[name] & qmask == qmask]
+    name_hits = []
+    field_hits = []
+    for name in names:
+      (name_text, fields_text) = texts[name]
+      if search(name_text):
+        name_hits.append(name)
+      elif search(fields_text):
+        field_hits.append(name)
+    matches = set(name_hits)
+    matches.update(field_hits)
+    if limit is None:
+      limit = len(matches)
+    most = limit * FUZZY_SCORED_PER_RESULT
+    if len(name_hits) > most:
+      name_hits = self._most_promising(query, pattern, name_hits, 0, most)
+    if len(field_hits) > most:
+      field_hits = self._most_promising(query, pattern, field_hits, 1, most)
+
+    unbeatable = best_score(len(query))
+    heap = [] # (score, _lastFirst(name)) of the best so far, worst first
+    for (hits, bonus) in ((name_hits, BONUS_NAME), (field_hits, 0)):
+      for name in hits:
+        if len(heap) >= limit and heap[0][0] >= unbeatable + bonus and name_order(name) > heap[0][1].order:
+          continue # Could only tie with the worst we have, and is listed after it
+        (name_text, fields_text) = texts[name]
+        score = None
+        if bonus:
+          score = fuzzy_score(query, name_text, pattern) + bonus
+        if score is None or score < unbeatable:
+          field_score = fuzzy_score(query, fields_text, pattern)
+          if field_score is not None and (score is None or field_score > score):
+            score = field_score
+        item = (score, _lastFirst(name))
+        if len(heap) < limit:
+          heapq.heappush(heap, item)
+        elif heap[0] < item:
+          heapq.heapreplace(heap, item)
+    heap.sort(reverse=True)
+    return (matches, [rank.name for (score, rank) in heap])
+
+  def _most_promising(self, query, pattern, names, part, count):
+    """
+    Pick count of the names whose text (0 for the name, 1 for the fields)
+    fuzzy_score() is likely to score best for the lowercased query and its
+    fuzzy_pattern(): those with the whole query starting a word, then those
+    with the best guess at a score from where a match starts and how much
+    of it is gaps, which cost more than anything else scores.
+    """
+    texts = self._texts
+    word_start = word_start_pattern(query).search
+    picked = []
+    rest = []
+    for name in names:
+      text = texts[name][part]
+      if query in text and word_start(text):
+        picked.append(name)
+        if len(picked) >= count:
+          return picked
+      else:
+        rest.append(name)
+    starts_word = fuzzy_pattern(query, word_start=True).search
+    consecutive = BONUS_CONSECUTIVE * (len(query) - 1)
+    def guess(name):
+      text = texts[name][part]
+      m = starts_word(text)
+      if m is not None:
+        bonus = BONUS_BOUNDARY * BONUS_FIRST_CHAR_MULTIPLIER
+      elif query in text:
+        return consecutive
+      else:
+        (m, bonus) = (pattern.search(text), 0)
+      gap = m.end() - m.start() - len(query)
+      if not gap:
+        return bonus + consecutive
+      return bonus + SCORE_GAP_START + SCORE_GAP_EXTENSION * (gap - 1)
+    picked.extend(heapq.nlargest(count - len(picked), rest, key=guess))
+    return picked
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Watch database files for changes made outside of this instance of kosh
+(e.g. by a git pull), so they can be merged in with KoshDB.reload().
+
+Both watchers have the same interface: check() returns the set of watched
+paths that changed since it was last called, and fileno() returns a file
+descriptor that becomes readable when there is something to check, or None
+if check() has to be polled instead.
+"""
+
+import os
+import struct
+
+class pollWatcher(object):
+  """Spots changes by comparing stat results, for when inotify is unavailable."""
+  def __init__(self, paths):
+    self._stats = {}
+    for path in paths:
+      self.add(path)
+
+  @staticmethod
+  def _stat(path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+  def add(self, path):
+    self._stats[path] = self._stat(path)
+
+  def fileno(self):
+    return None
+
+  def check(self):
+    changed = set()
+    for (path, old) in self._stats.items():
+      new = self._stat(path)
+      if new != old:
+        self._stats[path] = new
+        changed.add(path)
+    return changed
+
+  def close(self):
+    pass
+
+class inotifyWatcher(object):
+  """
+  Linux inotify watcher. The directories holding the files are watched
+  rather than the files themselves, so a file that gets replaced by renaming
+  another over it (as git and KoshDB.compact() do) is still followed.
+  """
+  IN_MODIFY      = 0x00000002
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO    = 0x00000080
+  IN_CREATE      = 0x00000100
+  IN_CLOEXEC     = 0o2000000
+  IN_NONBLOCK    = 0o4000
+  EVENT_HEADER   = struct.Struct('iIII') # wd, mask, cookie, len
+
+  def __init__(self, paths):
+    import ctypes, ctypes.util
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    self._dirs = {} # dirname -> watch descriptor
+    self._paths = {} # (watch descriptor, basename) -> path
+    try:
+      for path in paths:
+        self.add(path)
+    except:
+      self.close()
+      raise
+
+  def add(self, path):
+    import ctypes
+    (dirname, basename) = os.path.split(os.path.abspath(path))
+    if dirname not in self._dirs:
+      mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+      wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirname), mask)
+      if wd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', dirname)
+      self._dirs[dirname] = wd
+    self._paths[(self._dirs[dirname], os.fsencode(basename))] = path
+
+  def fileno(self):
+    return self._fd
+
+  def check(self):
+    changed = set()
+    while True:
+      try:
+        data = os.read(self._fd, 65536)
+      except BlockingIOError:
+        break
+      offset = 0
+      while offset < len(data):
+        (wd, mask, cookie, length) = self.EVENT_HEADER.unpack_from(data, offset)
+        offset += self.EVENT_HEADER.size
+        name = data[offset:offset+length].rstrip(b'\0')
+        offset += length
+        path = self._paths.get((wd, name))
+        if path is not None:
+          changed.add(path)
+    return changed
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+def watch(paths):
+  """Return an inotifyWatcher for paths where possible, otherwise a pollWatcher."""
+  try:
+    return inotifyWatcher(paths)
+  except (OSError, AttributeError): # AttributeError: no inotify, i.e. not Linux
+    return pollWatcher(paths)
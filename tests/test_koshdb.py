@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+try:
+  import fcntl
+except ImportError:
+  fcntl = None # Windows
+
+from koshdb.koshdb import KoshDB, passEntry, lazyPassEntry, _masterKey, ChecksumFailure, ReadOnlyDatabase
+
+PASSPHRASE = 'foobar'
+
+def prompt(message):
+  return PASSPHRASE
+
+class koshDBTestCase(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, 'koshdb')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def open(self, **kwargs):
+    return KoshDB(self.filename, prompt, **kwargs)
+
+  def add(self, db, name, **fields):
+    entry = passEntry(db._masterKeys[0], name=name)
+    with entry.batch():
+      for (field, value) in fields.items():
+        entry[field] = value
+    db[name] = entry
+    return entry
+
+class appendTests(koshDBTestCase):
+  def test_truncated_last_line(self):
+    db = self.open()
+    self.add(db, 'first', Username='alice', Password='secret')
+    db.write()
+    self.add(db, 'second', Username='bob', Password='hunter2', Notes='x' * 200)
+    db.write()
+    with open(self.filename, 'rb') as fp:
+      data = fp.read()
+    last_line = data[data.rstrip(b'\n').rfind(b'\n') + 1:]
+    for cut in (2, 30, 101, 150): # Not just the newline, see test_missing_final_newline()
+      self.assertLess(cut, len(last_line))
+      with open(self.filename, 'wb') as fp:
+        fp.write(data[:-cut])
+      reopened = self.open()
+      self.assertEqual(sorted(reopened.keys()), ['first'])
+      self.assertEqual(reopened['first']['Password'], 'secret')
+      self.assertEqual(len(reopened.warnings), 1)
+      # The next save must not leave the partial line in the middle of the file
+      self.add(reopened, 'third', Password='pass')
+      reopened.write()
+      again = self.open()
+      self.assertEqual(sorted(again.keys()), ['first', 'third'])
+      self.assertEqual(again.warnings, [])
+      # Put back the full file for the next cut
+      with open(self.filename, 'wb') as fp:
+        fp.write(data)
+
+  def test_missing_final_newline(self):
+    # e.g. after resolving a conflict in an editor that drops it
+    for format_version in (0, 1):
+      self.filename = os.path.join(self.dir, 'v%i' % format_version, 'koshdb')
+      db = self.open(format_version=format_version)
+      self.add(db, 'a', Password='one')
+      self.add(db, 'b', Password='two')
+      db.write()
+      with open(self.filename, 'rb') as fp:
+        data = fp.read()
+      with open(self.filename, 'wb') as fp:
+        fp.write(data.rstrip(b'\n'))
+      reopened = self.open()
+      self.assertEqual(sorted(reopened.keys()), ['a', 'b'])
+      self.assertEqual(reopened.warnings, [])
+      self.add(reopened, 'c', Password='three')
+      reopened.write()
+      self.assertFalse(os.path.exists(self.filename + '~')) # Appended, not rewritten
+      with open(self.filename, 'rb') as fp:
+        self.assertEqual(fp.read()[:len(data)], data)
+      again = self.open()
+      self.assertEqual(sorted(again.keys()), ['a', 'b', 'c'])
+      self.assertEqual(again['b']['Password'], 'two')
+
+  def test_failed_append_rolled_back(self):
+    db = self.open()
+    self.add(db, 'first', Password='secret')
+    db.write()
+    size = os.path.getsize(self.filename)
+    self.add(db, 'second', Password='hunter2')
+    real_fsync = os.fsync
+    def failing_fsync(fd):
+      raise OSError('disk full')
+    os.fsync = failing_fsync
+    try:
+      self.assertRaises(OSError, db.write)
+    finally:
+      os.fsync = real_fsync
+    self.assertEqual(os.path.getsize(self.filename), size)
+    db.write() # Retried
+    self.assertEqual(sorted(self.open().keys()), ['first', 'second'])
+
+class encryptOnceTests(koshDBTestCase):
+  """Each new revision of an entry should be encrypted exactly once."""
+  def count_encryptions(self, fn):
+    calls = []
+    def counting(real):
+      def wrapper(*args):
+        calls.append(args)
+        return real(*args)
+      return wrapper
+    with mock.patch.object(_masterKey, 'encrypt', counting(_masterKey.encrypt)), \
+        mock.patch.object(_masterKey, 'seal', counting(_masterKey.seal)):
+      fn()
+    return len(calls)
+
+  def check(self, format_version):
+    db = self.open(format_version=format_version)
+    self.add(db, 'existing', Username='alice', Password='secret')
+    self.assertEqual(self.count_encryptions(lambda:
+        db.importEntry({'name': 'imported', 'Username': 'bob', 'Password': 'pw'})), 1)
+    def new():
+      # As koshUI.new() and passwordForm.commit()
+      entry = passEntry(db._masterKeys[0])
+      with entry.batch():
+        entry['Username'] = ''
+        entry['Password'] = ''
+        entry['URL'] = ''
+      with entry.batch():
+        entry.name = 'new'
+        entry['Username'] = 'carol'
+        entry['Password'] = 'pw'
+        del entry['URL']
+      db[entry.name] = entry
+    self.assertEqual(self.count_encryptions(new), 1)
+    def edit():
+      # As passwordList.edit() and passwordForm.commit()
+      entry = db['existing'].clone()
+      with entry.batch():
+        entry['Password'] = 'changed'
+      db[entry.name] = entry
+    self.assertEqual(self.count_encryptions(edit), 1)
+    db.write()
+    reopened = self.open()
+    self.assertEqual(reopened['new']['Username'], 'carol')
+    self.assertEqual(reopened['existing']['Password'], 'changed')
+    self.assertEqual(reopened['imported']['Username'], 'bob')
+
+  def test_v0(self):
+    self.check(0)
+
+  def test_v1(self):
+    self.check(1)
+
+class recordFormatTests(unittest.TestCase):
+  def setUp(self):
+    self.key = _masterKey(PASSPHRASE)
+
+  def entry(self, record_format, name='Example Mail', **fields):
+    entry = passEntry(self.key, name=name)
+    entry._format = record_format
+    with entry.batch():
+      for (field, value) in fields.items():
+        entry[field] = value
+      entry.timestamp()
+    return entry
+
+  def legacy_line(self, entry):
+    """A p: line as written before key hints and split entries."""
+    contents = json.dumps((entry.name, entry._timestamp, dict(entry), entry.meta))
+    return passEntry.BLOB_PREFIX + self.key.encrypt(contents)
+
+  def test_v1_smaller_than_v0(self):
+    for fields in ({}, {'Password': 'x'},
+        {'Username': 'alice@example.com', 'Password': 'correct horse battery',
+          'URL': 'https://mail.example.com/'}):
+      for name in ('n', 'Example Mail'):
+        entry = self.entry(1, name, **fields)
+        self.assertLess(len(bytes(entry)), len(self.legacy_line(entry)))
+
+  def test_v1_round_trip(self):
+    line = bytes(self.entry(1, Username='alice', Password='secret'))
+    entry = passEntry.from_line(self.key, line)
+    self.assertIsInstance(entry, lazyPassEntry)
+    self.assertEqual(entry.name, 'Example Mail')
+    self.assertEqual(entry['Password'], 'secret')
+
+  def test_v1_body_tied_to_head(self):
+    (prefix, hint, head, body) = bytes(self.entry(1, Password='secret')).split(b':')
+    (_prefix, _hint, other_head, other_body) = bytes(self.entry(1, Password='other')).split(b':')
+    spliced = passEntry.from_line(self.key, b':'.join((prefix, hint, head, other_body)))
+    self.assertRaises(ChecksumFailure, len, spliced)
+    self.assertRaises(ChecksumFailure, passEntry.from_line, _masterKey('other key'),
+        b':'.join((prefix, hint, head, body)))
+
+class compatibilityTests(koshDBTestCase):
+  def test_v0_readable_by_older_kosh(self):
+    db = self.open()
+    self.add(db, 'first', Username='alice', Password='secret')
+    db.write()
+    self.add(db, 'second', Password='hunter2')
+    db.compact()
+    self.add(db, 'third', Password='pass')
+    db.write()
+    key = db._masterKeys[0]
+    with open(self.filename, 'rb') as fp:
+      self.assertEqual(fp.readline(), b'K05Hv0 UNSTABLE\n')
+      lines = [line for line in fp if line.startswith(b'p:')]
+    self.assertEqual(len(lines), 3)
+    for line in lines:
+      # As read before key hints and split entries
+      (name, timestamp, fields, meta) = json.loads(key.decrypt(line[2:].strip()))
+      self.assertIn(name, ('first', 'second', 'third'))
+
+  def test_key_file_keeps_its_header(self):
+    from koshdb import merge
+    db = self.open()
+    self.add(db, 'entry', Password='secret')
+    db.write()
+    key = db._masterKeys[0]
+    del db
+    # Migrate the main file only, as the README describes
+    with open(self.filename + '.new', 'wb') as out:
+      merge.merge([self.filename], out, convert=merge.converter([key], 1), version=1)
+    os.rename(self.filename + '.new', self.filename)
+    db = self.open()
+    self.assertEqual(db.format_version, 1)
+    self.add(db, 'other', Password='hunter2')
+    db.compact()
+    with open(self.filename, 'rb') as fp:
+      self.assertEqual(fp.readline(), KoshDB.FILE_HEADER_V1)
+    with open(self.filename + '.key', 'rb') as fp:
+      self.assertEqual(fp.readline(), KoshDB.FILE_HEADER)
+
+class lazyV1Tests(koshDBTestCase):
+  def test_history_stays_lazy(self):
+    db = self.open(format_version=1)
+    for password in ('one', 'two', 'three'):
+      self.add(db, 'entry', Password=password)
+    db.write()
+    reopened = self.open()
+    self.assertEqual(len(reopened['entry']._history), 3)
+    for revision in reopened['entry'].history():
+      self.assertIsInstance(revision, lazyPassEntry)
+    # Saving an unchanged revision still compares the fields
+    self.add(reopened, 'entry', Password='three')
+    self.assertEqual(len(reopened['entry']._history), 3)
+    self.assertEqual(reopened._pending, [])
+
+class parallelTests(koshDBTestCase):
+  def test_pool_only_used_opening(self):
+    db = self.open()
+    self.add(db, 'first', Password='secret')
+    db.write()
+    key = db._masterKeys[0]
+    def in_process(db, lines):
+      return [db._decrypt_entry(line) for line in lines]
+    with mock.patch.object(KoshDB, 'PARALLEL_MIN_LINES', 1), \
+        mock.patch.object(KoshDB, '_decrypt_parallel', autospec=True, side_effect=in_process) as parallel:
+      reopened = self.open(jobs=2)
+      self.assertEqual(parallel.call_count, 1)
+      # As pulled in by git while kosh is open
+      entry = passEntry(key, name='second')
+      entry['Password'] = 'hunter2'
+      entry.timestamp()
+      with open(self.filename, 'ab') as fp:
+        fp.write(bytes(entry) + b'\n')
+      self.assertEqual(reopened.reload(), set(['second']))
+      self.assertEqual(parallel.call_count, 1)
+    self.assertEqual(reopened['second']['Password'], 'hunter2')
+
+class shardTests(koshDBTestCase):
+  def test_entries_in_their_shard(self):
+    db = self.open()
+    key = db._masterKeys[0]
+    self.assertNotEqual(key.shard_key(), key._key)
+    db.shard(3)
+    names = ['entry %i' % i for i in range(40)]
+    for name in names:
+      self.add(db, name, Password=name)
+    db.write()
+    reopened = self.open()
+    self.assertEqual(sorted(reopened.keys()), sorted(names))
+    sources = dict([(id(item), source) for (item, source) in reopened._lines])
+    shards = set()
+    for name in names:
+      shard = reopened._shard_for(name)
+      self.assertEqual(sources[id(reopened[name])], shard)
+      shards.add(shard)
+    self.assertEqual(len(shards), 3)
+    # The layout survives changing the passphrase
+    reopened.change_passphrase('new passphrase')
+    self.assertEqual(set(map(reopened._shard_for, names)), shards)
+
+class archiveTests(koshDBTestCase):
+  DAY = 24 * 60 * 60
+
+  def setUp(self):
+    koshDBTestCase.setUp(self)
+    self.now = int(time.time())
+    self.db = self.open()
+
+  def revision(self, name, days_ago, meta={}, **fields):
+    """Add a revision of name as if it had been saved days_ago."""
+    entry = passEntry(self.db._masterKeys[0], name=name)
+    for (field, value) in fields.items():
+      entry[field] = value
+    entry.meta.update(meta)
+    entry._timestamp = self.now - days_ago * self.DAY
+    entry._changed() # Encrypts it, as timestamp() would
+    self.db[entry.name] = entry
+
+  def history(self, db, name):
+    return [revision._timestamp for revision in db[name].history()]
+
+  def days_ago(self, *days):
+    return [self.now - d * self.DAY for d in days]
+
+  def test_keep(self):
+    for (days, password) in ((4, 'one'), (3, 'two'), (2, 'three'), (1, 'four')):
+      self.revision('a', days, Password=password)
+    self.revision('b', 1, Password='only')
+    self.assertEqual(self.db.compact(keep=2), 2)
+    reopened = self.open()
+    self.assertEqual(self.history(reopened, 'a'), self.days_ago(1, 2))
+    self.assertEqual(self.history(reopened, 'b'), self.days_ago(1))
+    self.assertTrue(reopened.has_archive())
+    self.assertTrue(reopened.load_archive())
+    self.assertEqual(self.history(reopened, 'a'), self.days_ago(1, 2, 3, 4))
+    self.assertEqual(reopened['a'].older.older.older['Password'], 'one')
+    self.assertEqual(reopened['a']['Password'], 'four')
+    self.assertFalse(reopened.load_archive())
+
+  def test_newer_than(self):
+    for days in (10, 5, 1):
+      self.revision('a', days, Password=str(days))
+    self.assertEqual(self.db.compact(keep=2, newer_than=self.now - 3 * self.DAY), 1)
+    self.assertEqual(self.history(self.open(), 'a'), self.days_ago(1, 5))
+    # The newest revision stays however old it is
+    self.assertEqual(self.db.compact(newer_than=self.now), 1)
+    self.assertEqual(self.history(self.open(), 'a'), self.days_ago(1))
+
+  def test_tombstones(self):
+    for name in ('expired', 'recent'):
+      self.revision(name, 20, Password='one')
+      self.revision(name, 15, Password='two')
+    self.revision('expired', 10, meta={'Deleted': True})
+    self.revision('recent', 1, meta={'Deleted': True})
+    # The revision a tombstone deleted is kept with it
+    self.assertEqual(self.db.compact(keep=1), 2)
+    # Once older than newer_than, the rest of the history goes too
+    self.assertEqual(self.db.compact(newer_than=self.now - 5 * self.DAY), 2)
+    reopened = self.open()
+    self.assertEqual(sorted(reopened.keys()), [])
+    (recent, deleted) = reopened._histories['recent']._entries
+    self.assertEqual((recent._timestamp, deleted.meta), (self.now - 15 * self.DAY, {'Deleted': True}))
+    self.assertNotIn('expired', reopened._histories)
+    reopened.load_archive()
+    self.assertEqual(sorted(reopened.keys()), [])
+    self.assertEqual(len(reopened._histories['expired']), 3)
+
+  def test_rename(self):
+    self.revision('old', 10, Password='secret')
+    self.revision('new', 5, meta={'RenamedFrom': 'old'}, Password='secret')
+    # Without newer_than, the revision under the old name stays
+    self.assertEqual(self.db.compact(keep=1), 0)
+    self.assertEqual(self.db.compact(keep=1, newer_than=self.now - 3 * self.DAY), 1)
+    reopened = self.open()
+    self.assertEqual(sorted(reopened.keys()), ['new'])
+    self.assertEqual(self.history(reopened, 'new'), self.days_ago(5))
+
+class lockTests(koshDBTestCase):
+  def shared_lock_available(self):
+    """Whether another process could open the database read only now."""
+    # fcntl locks are per process, so another instance here would never conflict
+    script = ('import fcntl, sys\n'
+        'fcntl.lockf(open(sys.argv[1], "rb+"), fcntl.LOCK_SH | fcntl.LOCK_NB)')
+    return subprocess.call([sys.executable, '-c', script, self.filename],
+        stderr=subprocess.DEVNULL) == 0
+
+  @unittest.skipIf(fcntl is None, 'needs fcntl locks')
+  def test_downgrade_after_save(self):
+    db = self.open()
+    self.add(db, 'first', Password='secret')
+    db.write()
+    del db # Closed, releasing its lock
+    db = self.open(read_only=True)
+    self.assertTrue(self.shared_lock_available())
+    db.upgrade_lock()
+    self.assertFalse(self.shared_lock_available())
+    self.add(db, 'second', Password='hunter2')
+    db.downgrade_lock() # Not yet written
+    self.assertFalse(db.read_only)
+    db.write()
+    db.downgrade_lock()
+    self.assertTrue(db.read_only)
+    self.assertTrue(self.shared_lock_available())
+    self.add(db, 'third', Password='pass')
+    self.assertRaises(ReadOnlyDatabase, db.write)
+    db.upgrade_lock()
+    db.write()
+    db.downgrade_lock()
+    self.assertEqual(sorted(self.open().keys()), ['first', 'second', 'third'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import unittest
+
+from koshdb import merge
+from koshdb.koshdb import KoshDB, passEntry
+from .test_koshdb import koshDBTestCase
+
+class mergeTests(koshDBTestCase):
+  def write_file(self, name, lines, header=KoshDB.FILE_HEADER):
+    filename = os.path.join(self.dir, name)
+    with open(filename, 'wb') as fp:
+      fp.write(header + b''.join([line + b'\n' for line in lines]))
+    return filename
+
+  def merged_lines(self, *args, **kwargs):
+    out = io.BytesIO()
+    merge.merge(*args, out=out, **kwargs)
+    return out.getvalue().splitlines()
+
+  def test_migrated_between_formats(self):
+    db = self.open()
+    self.add(db, 'entry', Password='secret')
+    key = db._masterKeys[0]
+    plain = bytes(db['entry'])
+    filename = self.write_file('v0', [plain])
+    # Copies migrated separately still merge line for line
+    migrated = [self.merged_lines([filename], convert=merge.converter([key], 1), version=1)
+        for i in range(2)]
+    self.assertEqual(migrated[0], migrated[1])
+    (header, line) = migrated[0]
+    self.assertEqual(header, KoshDB.FILE_HEADER_V1.strip())
+    self.assertTrue(merge.is_format(line, 1))
+    self.assertEqual(passEntry.from_line(key, line)['Password'], 'secret')
+    filename = self.write_file('v1', [line], header=KoshDB.FILE_HEADER_V1)
+    lines = self.merged_lines([filename], convert=merge.converter([key], 0), version=0)
+    self.assertEqual(len(lines), 2)
+    self.assertTrue(merge.is_format(lines[1], 0))
+    self.assertEqual(passEntry.from_line(key, lines[1])['Password'], 'secret')
+
+  def test_git_driver_leaves_out_ancestor(self):
+    """
+    The README's git merge driver runs "kosh-merge %A %B -o %A". Lines only
+    the common ancestor %O has were dropped on both sides since (e.g. moved
+    to the archive by compaction), so merging it too would bring them back.
+    """
+    db = self.open()
+    old = bytes(self.add(db, 'entry', Password='old'))
+    new = bytes(self.add(db, 'entry', Password='new'))
+    ours_only = bytes(self.add(db, 'ours', Password='ours'))
+    theirs_only = bytes(self.add(db, 'theirs', Password='theirs'))
+    ancestor = self.write_file('ancestor', [old, new])
+    ours = self.write_file('ours', [new, ours_only])
+    theirs = self.write_file('theirs', [new, theirs_only])
+    self.assertEqual(self.merged_lines([ours, theirs])[1:], [new, ours_only, theirs_only])
+    self.assertIn(old, self.merged_lines([ours, ancestor, theirs]))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vi:sw=2:ts=2:expandtab
+
+# Copyright (C) 2009-2025 Ian Munsie
+#
+# Kosh is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Kosh is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Kosh.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import threading
+import unittest
+from unittest import mock
+
+from koshdb import search
+from koshdb.search import ngramIndex, trigramIndex, fuzzy_pattern, FUZZY_SCORED_PER_RESULT
+from koshdb.koshdb import lazyPassEntry
+from tests.test_koshdb import koshDBTestCase
+
+class ngramIndexTests(unittest.TestCase):
+  def test_postings_kept_up_to_date(self):
+    index = ngramIndex()
+    index.add('a', ['Example.com'])
+    index.add('b', ['other'])
+    self.assertEqual(index.search('ample'), set(['a']))
+    # Changes after a trigram has been searched for are picked up
+    index.add('c', ['sample'])
+    index.discard('a')
+    index.add('b', ['an example'])
+    self.assertEqual(index.search('ample'), set(['b', 'c']))
+    self.assertEqual(index.search('ample', within=set(['c'])), set(['c']))
+    self.assertEqual(index.search('xyz'), set())
+
+class fuzzyTests(unittest.TestCase):
+  def test_pattern_finds_leftmost_match(self):
+    texts = ['connect to corp', 'c\0orp corp', 'xcxoxrxpx', 'corrp', 'cccooorrrppp', 'corq']
+    for query in ('corp', 'cp', 'rr', 'c]^-\\'):
+      lazy = re.compile('[^\0]*?'.join([re.escape(c) for c in query]))
+      for text in texts + [query]:
+        (m, expected) = (fuzzy_pattern(query).search(text), lazy.search(text))
+        self.assertEqual(m and m.span(), expected and expected.span(), (query, text))
+
+  def test_scores_most_promising(self):
+    index = trigramIndex()
+    limit = 2
+    for i in range(limit * FUZZY_SCORED_PER_RESULT * 3):
+      index.add('gapped %i' % i, {'Notes': 'cxoxrxp %i' % i})
+    index.add('mid word', {'Notes': 'acorpb'})
+    index.add('word start 1', {'Notes': 'the corp office'})
+    index.add('word start 2', {'URL': 'https://corp.example'})
+    with mock.patch.object(search, 'fuzzy_score', wraps=search.fuzzy_score) as fuzzy_score:
+      (matches, best) = index.fuzzy('corp', limit=limit)
+    self.assertEqual(len(matches), len(index))
+    self.assertEqual(sorted(best), ['word start 1', 'word start 2'])
+    self.assertLessEqual(fuzzy_score.call_count, limit * FUZZY_SCORED_PER_RESULT)
+    # Every match is scored when there are few enough of them
+    self.assertEqual(index.fuzzy('corp')[1][:2], best)
+
+  def test_ties_listed_by_name(self):
+    names = ['tied %i' % i for i in range(6)] + ['Tied 1']
+    for fields in ({'Notes': 'corp'}, {'Notes': 'the c-o-r-p'}):
+      for order in (names, names[::-1]):
+        index = trigramIndex()
+        for name in order:
+          index.add(name, fields)
+        self.assertEqual(index.fuzzy('corp', limit=3)[1], ['tied 0', 'Tied 1', 'tied 1'])
+
+class backgroundIndexTests(koshDBTestCase):
+  def setUp(self):
+    koshDBTestCase.setUp(self)
+    self.db = self.open()
+    for name in ('first', 'second', 'third'):
+      self.add(self.db, name, Username=name + ' user')
+
+  def test_changes_while_building(self):
+    started = threading.Event()
+    release = threading.Event()
+    built_on = []
+    add = trigramIndex.add
+    def slow_add(index, name, fields):
+      built_on.append(threading.current_thread())
+      started.set()
+      release.wait()
+      add(index, name, fields)
+    with mock.patch.object(trigramIndex, 'add', slow_add):
+      self.db.start_search_index()
+      started.wait()
+      # Made while the index is being built from the entries as they were
+      self.add(self.db, 'fourth', Username='fourth user')
+      del self.db[self.db['second']]
+      self.add(self.db, 'third', Username='renamed')
+      release.set()
+      self.assertEqual(self.db.search('user'), set(['first', 'fourth']))
+    self.assertIsNot(built_on[0], threading.current_thread())
+    self.assertEqual(self.db.search('renamed'), set(['third']))
+
+  def test_build_error_raised_by_search(self):
+    with mock.patch.object(trigramIndex, 'add', side_effect=ValueError('bad entry')):
+      self.db.start_search_index()
+      with self.assertRaises(ValueError):
+        self.db.search('user')
+    self.assertEqual(self.db.search('user'), set(['first', 'second', 'third']))
+
+  def test_lazy_entries_left_to_search(self):
+    self.filename += '-v1'
+    db = self.open(format_version=1)
+    for name in ('first', 'second'):
+      self.add(db, name, Username=name + ' user')
+    db.write()
+    db = self.open()
+    self.add(db, 'third', Username='third user')
+    revealed_on = []
+    reveal = lazyPassEntry._reveal
+    def recording_reveal(entry):
+      revealed_on.append(threading.current_thread())
+      reveal(entry)
+    with mock.patch.object(lazyPassEntry, '_reveal', recording_reveal):
+      db.start_search_index()
+      db._index_thread.join()
+      self.assertEqual(revealed_on, [])
+      self.assertEqual(db.search('user'), set(['first', 'second', 'third']))
+    self.assertEqual(revealed_on, [threading.current_thread()] * 2)
+
+if __name__ == '__main__':
+  unittest.main()